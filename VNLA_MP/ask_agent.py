@@ -3,6 +3,7 @@
 
 from __future__ import division
 
+import contextlib
 import json
 import os
 import sys
@@ -18,7 +19,14 @@ import torch.nn.functional as F
 
 from utils import padding_idx
 from agent import BaseAgent
-from oracle import make_oracle
+from oracle import make_oracle, AskOracle
+
+
+def make_grad_scaler(enabled):
+    ''' GradScaler for the losses of -amp; a no-op when not enabled. '''
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
 
 
 class AskAgent(BaseAgent):
@@ -69,6 +77,14 @@ class AskAgent(BaseAgent):
 
         self.coverage_size = hparams.coverage_size if hasattr(hparams, 'coverage_size') else None
 
+        # Mixed precision: fp16 with loss scaling on GPU, bfloat16 on CPU
+        self.amp = hparams.amp if hasattr(hparams, 'amp') else 0
+        if self.amp and not hasattr(torch, 'autocast'):
+            print('torch.autocast is not available, falling back to fp32')
+            self.amp = 0
+        self.amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+        self.scaler = make_grad_scaler(bool(self.amp) and device.type == 'cuda')
+
     @staticmethod
     def n_input_nav_actions():
         return len(AskAgent.nav_actions)
@@ -87,7 +103,7 @@ class AskAgent(BaseAgent):
 
     def _make_batch(self, obs):
         ''' Make a variable for a batch of input instructions. '''
-        seq_tensor = np.array([self.env.encode(ob['instruction']) for ob in obs])
+        seq_tensor = self.env.encode_batch([ob['instruction_words'] for ob in obs])
 
         seq_lengths = np.argmax(seq_tensor == padding_idx, axis=1)
 
@@ -103,6 +119,9 @@ class AskAgent(BaseAgent):
 
     def _feature_variable(self, obs):
         ''' Make a variable for a batch of precomputed image features. '''
+        if hasattr(obs, 'state'):
+            # BatchedObservations: gather all rows at once
+            return torch.from_numpy(obs.state.features()).to(self.device)
         feature_size = obs[0]['feature'].shape[0]
         features = np.empty((len(obs),feature_size), dtype=np.float32)
         for i,ob in enumerate(obs):
@@ -113,20 +132,12 @@ class AskAgent(BaseAgent):
         return logit.max(1)[1].detach()
 
     def _sample(self, logit):
-        prob = F.softmax(logit, dim=1).contiguous()
-
-        # Weird bug with torch.multinomial: it samples even zero-prob actions.
-        while True:
-            sample = torch.multinomial(prob, 1, replacement=True).view(-1)
-            is_good = True
-            for i in range(logit.size(0)):
-                if logit[i, sample[i].item()].item() == -float('inf'):
-                    is_good = False
-                    break
-            if is_good:
-                break
-
-        return sample
+        ''' Sample from softmax(logit) with the Gumbel-max trick. Masked (-inf)
+        actions are never drawn, with no resampling and no host syncs. '''
+        logit = logit.detach()
+        gumbel = -torch.empty_like(logit).exponential_().log()
+        scores = (logit + gumbel).masked_fill(logit == -float('inf'), -float('inf'))
+        return scores.max(1)[1]
 
     def _next_action(self, name, logit, target, feedback):
         ''' Determine the next action to take based on the training algorithm. '''
@@ -141,9 +152,7 @@ class AskAgent(BaseAgent):
 
     def _populate_agent_state_to_obs(self, obs, *args):
         nav_softmax, queries_unused, traj, ended, time_step = args
-        nav_dist = nav_softmax.data.tolist()
         for i, ob in enumerate(obs):
-            ob['nav_dist'] = nav_dist[i]
             ob['queries_unused'] = queries_unused[i]
             ob['agent_path'] = traj[i]['agent_path']
             ob['ended'] = ended[i]
@@ -152,6 +161,38 @@ class AskAgent(BaseAgent):
     def _should_ask(self, ended, q):
         return not ended and q == self.ask_actions.index('ask')
 
+    def _fill_logit_masks(self, obs, nav_logit_mask, ask_logit_mask, queries_unused):
+        ''' Mask invalid actions in place: `forward` where no location is
+        navigable and `ask` where the budget (a device tensor) is spent. '''
+        if hasattr(obs, 'state'):
+            nav_count = obs.state.nav_count()
+        else:
+            nav_count = np.array([len(ob['navigableLocations']) for ob in obs])
+        nav_logit_mask[:, self.nav_actions.index('forward')] = \
+            torch.from_numpy(nav_count <= 1).to(self.device)
+        ask_logit_mask[:, self.ask_actions.index('ask')] = queries_unused <= 0
+
+    def _to_host(self, *tensors):
+        ''' Values of several (batch_size,) long tensors as lists, fetched with
+        a single device-to-host copy (through pinned memory on CUDA) instead of
+        one synchronizing .tolist() per tensor. '''
+        stacked = torch.stack([t.detach() for t in tensors])
+        if stacked.is_cuda:
+            host = torch.empty(stacked.size(), dtype=stacked.dtype, pin_memory=True)
+            host.copy_(stacked)
+            stacked = host
+        return stacked.tolist()
+
+    def _set_rows(self, t, rows, values):
+        ''' Copy of device tensor `t` with `rows` set to `values`, or `t`
+        itself if no row changes. '''
+        if not rows:
+            return t
+        t = t.clone()
+        t[torch.tensor(rows, dtype=torch.long, device=self.device)] = \
+            torch.tensor(values, dtype=t.dtype, device=self.device)
+        return t
+
     def rollout(self):
         # Reset environment
         obs = self.env.reset(self.is_eval)
@@ -207,34 +248,30 @@ class AskAgent(BaseAgent):
 
         env_action = [None] * batch_size
         queries_unused = [ob['max_queries'] for ob in obs]
+        traj_lens = np.array([ob['traj_len'] for ob in obs])
+        # Number of trailing steps spent at the same viewpoint
+        unmoved = np.ones(batch_size, dtype=np.int64)
+
+        # Rollout state kept on the device; the masks are refilled in place
+        queries_unused_t = torch.tensor(queries_unused, dtype=torch.long, device=self.device)
+        traj_lens_t = torch.from_numpy(traj_lens).long().to(self.device)
+        nav_logit_mask = torch.zeros(batch_size,
+            AskAgent.n_output_nav_actions(), dtype=torch.uint8, device=self.device)
+        ask_logit_mask = torch.zeros(batch_size,
+            AskAgent.n_output_ask_actions(), dtype=torch.uint8, device=self.device)
 
         episode_len = max(ob['traj_len'] for ob in obs)
 
         for time_step in range(episode_len):
 
-            nav_logit_mask = torch.zeros(batch_size,
-                AskAgent.n_output_nav_actions(), dtype=torch.uint8, device=self.device)
-            ask_logit_mask = torch.zeros(batch_size,
-                AskAgent.n_output_ask_actions(), dtype=torch.uint8, device=self.device)
-
             # Mask invalid actions
-            nav_mask_indices = []
-            ask_mask_indices = []
-            for i, ob in enumerate(obs):
-                if len(ob['navigableLocations']) <= 1:
-                    nav_mask_indices.append((i, self.nav_actions.index('forward')))
-
-                if queries_unused[i] <= 0:
-                    ask_mask_indices.append((i, self.ask_actions.index('ask')))
-
-            nav_logit_mask[list(zip(*nav_mask_indices))] = 1
-            ask_logit_mask[list(zip(*ask_mask_indices))] = 1
+            self._fill_logit_masks(obs, nav_logit_mask, ask_logit_mask, queries_unused_t)
 
             # Image features
             f_t = self._feature_variable(obs)
 
             # Budget features
-            b_t = torch.tensor(queries_unused, dtype=torch.long, device=self.device)
+            b_t = queries_unused_t
 
             # Take a decoding step
             decoder_h, alpha, nav_logit, nav_softmax, ask_logit, cov = \
@@ -245,7 +282,9 @@ class AskAgent(BaseAgent):
                 traj, ended, time_step)
 
             # Query teacher for next actions
-            nav_target, ask_target, ask_reason = self.teacher(obs)
+            ask_target, ask_reason = self.teacher.next_ask_batch(obs, nav_softmax,
+                queries_unused_t, traj_lens_t, time_step, unmoved, ended)
+            nav_target = self.teacher.next_nav(obs)
 
             # Nav loss
             nav_target = torch.tensor(nav_target, dtype=torch.long, device=self.device)
@@ -253,7 +292,6 @@ class AskAgent(BaseAgent):
                 self.nav_loss += self.nav_criterion(nav_logit, nav_target)
 
             # Ask loss
-            ask_target = torch.tensor(ask_target, dtype=torch.long, device=self.device)
             if not self.is_eval and not (self.random_ask or self.ask_first or self.teacher_ask or self.no_ask):
                 self.ask_loss += self.ask_criterion(ask_logit, ask_target)
 
@@ -261,11 +299,11 @@ class AskAgent(BaseAgent):
             a_t = self._next_action('nav', nav_logit, nav_target, self.nav_feedback)
             q_t = self._next_action('ask', ask_logit, ask_target, self.ask_feedback)
 
-            nav_target_list = nav_target.data.tolist()
-            ask_target_list = ask_target.data.tolist()
-            a_t_list = a_t.data.tolist()
-            q_t_list = q_t.data.tolist()
+            # One host sync per step
+            ask_target_list, ask_reason_list, a_t_list, q_t_list = self._to_host(
+                ask_target, ask_reason, a_t, q_t)
 
+            askers = []
             for i in range(batch_size):
                 # Change ask action according to policy
                 if ask_target_list[i] != self.ask_actions.index('<ignore>'):
@@ -280,37 +318,49 @@ class AskAgent(BaseAgent):
 
                 # If ask
                 if self._should_ask(ended[i], q_t_list[i]):
-                    # Query advisor for subgoals
-                    subgoals[i] = self.advisor(obs[i])
+                    askers.append(i)
+
+            # Query advisor for the subgoals of all agents that asked at once
+            if askers:
+                for i, subgoal in zip(askers,
+                        self.advisor.batch_call([obs[i] for i in askers])):
+                    subgoals[i] = subgoal
                     # Reset subgoal step index
                     n_subgoal_steps[i] = 0
                     # Decrement queries unused
                     queries_unused[i] -= 1
+                queries_unused_t = self._set_rows(queries_unused_t, askers,
+                    [queries_unused[i] for i in askers])
 
+            overridden = []
+            for i in range(batch_size):
                 # Direct advisor: If still executing a subgoal, overwrite agent's
                 #   decision by advisor's decision.
                 if n_subgoal_steps[i] < len(subgoals[i]):
                     a_t_list[i] = subgoals[i][n_subgoal_steps[i]]
                     n_subgoal_steps[i] += 1
+                    overridden.append(i)
 
                 # Map the agent's action back to the simulator's action space.
                 env_action[i] = self.teacher.interpret_agent_action(a_t_list[i], obs[i])
 
-            a_t = torch.tensor(a_t_list, dtype=torch.long, device=self.device)
-            q_t = torch.tensor(q_t_list, dtype=torch.long, device=self.device)
+            a_t = self._set_rows(a_t, overridden, [a_t_list[i] for i in overridden])
+            if self.random_ask or self.ask_first or self.teacher_ask or self.no_ask:
+                q_t = torch.tensor(q_t_list, dtype=torch.long, device=self.device)
 
             # Execute nav actions
             obs = self.env.step(env_action, obs)
 
             # Update history
-            ask_target_list = ask_target.data.tolist()
             for i, ob in enumerate(obs):
                 if not ended[i]:
+                    unmoved[i] = unmoved[i] + 1 \
+                        if ob['viewpoint'] == traj[i]['agent_path'][-1][0] else 1
                     traj[i]['agent_path'].append((ob['viewpoint'], ob['heading'], ob['elevation']))
                     traj[i]['agent_nav'].append(env_action[i])
                     traj[i]['teacher_ask'].append(ask_target_list[i])
                     traj[i]['agent_ask'].append(q_t_list[i])
-                    traj[i]['teacher_ask_reason'].append(ask_reason[i])
+                    traj[i]['teacher_ask_reason'].append(AskOracle.REASONS[ask_reason_list[i]])
 
                     if self._should_ask(ended[i], q_t_list[i]):
                         traj[i]['subgoals'].append(
@@ -357,6 +407,11 @@ class AskAgent(BaseAgent):
         self.nav_losses = []
         self.ask_losses = []
 
+    def _autocast(self):
+        if not self.amp:
+            return contextlib.suppress()  # no-op context
+        return torch.autocast(self.device.type, dtype=self.amp_dtype)
+
     def test(self, env, feedback, use_dropout=False, allow_cheat=False):
         ''' Evaluate once on each instruction in the current environment '''
 
@@ -367,7 +422,8 @@ class AskAgent(BaseAgent):
             self.model.train()
         else:
             self.model.eval()
-        return BaseAgent.test(self, env)
+        with self._autocast():
+            return BaseAgent.test(self, env)
 
     def train(self, env, optimizer, n_iters, feedback):
         ''' Train for a given number of iterations '''
@@ -379,11 +435,13 @@ class AskAgent(BaseAgent):
         last_traj = []
         for iter in range(1, n_iters + 1):
             optimizer.zero_grad()
-            traj = self.rollout()
+            with self._autocast():
+                traj = self.rollout()
             if n_iters - iter <= 10:
                 last_traj.extend(traj)
-            self.loss.backward()
-            optimizer.step()
+            self.scaler.scale(self.loss).backward()
+            self.scaler.step(optimizer)
+            self.scaler.update()
 
         return last_traj
 
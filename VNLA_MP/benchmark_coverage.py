@@ -0,0 +1,82 @@
+from __future__ import division
+
+import time
+import argparse
+
+import torch
+
+from model import Attention, COVERAGE_IMPLS
+
+'''
+Time one attention step with coverage (forward and backward) for each
+coverage GRU implementation (see `-coverage_impl`), on CPU and, if available,
+on GPU, and check that all of them agree with nn.GRU.
+
+Usage: python benchmark_coverage.py [-batch_size 100] [-seq_len 50] [-hidden_size 512]
+           [-coverage_size 10] [-n_iters 50]
+'''
+
+
+def make_inputs(args, device):
+    h = torch.randn(args.batch_size, args.hidden_size, device=device, requires_grad=True)
+    context = torch.randn(args.batch_size, args.seq_len, args.hidden_size, device=device)
+    cov = torch.randn(args.batch_size, args.seq_len, args.coverage_size, device=device)
+    # Padding mask of the last quarter of each instruction
+    mask = (torch.arange(args.seq_len, device=device) >= args.seq_len * 3 // 4).expand(
+        args.batch_size, args.seq_len)
+    return h, context, mask, cov
+
+def step(attention, inputs):
+    h_tilde, _, new_cov = attention(*inputs)
+    (h_tilde.sum() + new_cov.sum()).backward()
+    return h_tilde, new_cov
+
+def benchmark(args, device):
+    torch.manual_seed(0)
+    reference = Attention(args.hidden_size, args.coverage_size, coverage_impl='gru').to(device)
+    inputs = make_inputs(args, device)
+    expected = step(reference, inputs)
+
+    print('\n*** %s' % device)
+    print('%-10s %12s %10s %12s' % ('impl', 'ms/step', 'speedup', 'max diff'))
+    base_time = None
+    for impl in COVERAGE_IMPLS:
+        attention = Attention(args.hidden_size, args.coverage_size,
+            coverage_impl=impl).to(device)
+        attention.load_state_dict(reference.state_dict())
+        # Warm up (TorchScript profiling runs, cuDNN, allocator)
+        for _ in range(5):
+            outputs = step(attention, inputs)
+        diff = max((x - y).abs().max().item() for x, y in zip(outputs, expected))
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(args.n_iters):
+            step(attention, inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.time() - start) / args.n_iters * 1000
+        if base_time is None:
+            base_time = elapsed
+        print('%-10s %12.3f %9.2fx %12.2e' % (attention.coverage_impl, elapsed,
+            base_time / elapsed, diff))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-batch_size', type=int, default=100)
+    parser.add_argument('-seq_len', type=int, default=50)
+    parser.add_argument('-hidden_size', type=int, default=512)
+    parser.add_argument('-coverage_size', type=int, default=10)
+    parser.add_argument('-n_iters', type=int, default=50)
+    args = parser.parse_args()
+
+    devices = [torch.device('cpu')]
+    if torch.cuda.is_available():
+        devices.append(torch.device('cuda'))
+    for device in devices:
+        benchmark(args, device)
+
+
+if __name__ == "__main__":
+    main()
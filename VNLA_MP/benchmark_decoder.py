@@ -0,0 +1,164 @@
+from __future__ import division
+
+import sys
+import json
+import time
+from argparse import Namespace
+
+import torch
+
+from model import AttentionSeq2SeqModel, DECODER_COMPILERS
+from ask_agent import AskAgent
+from verbal_ask_agent import VerbalAskAgent
+from flags import make_parser
+
+'''
+Check that the compiled decode steps (see `-compile_decoder`) match the eager
+one, in evaluation mode and, without dropout, in training mode (outputs and
+parameter gradients), then report decoding steps/sec of each of them for
+several batch sizes on CPU and, if available, on GPU.
+
+Usage: python benchmark_decoder.py -config_file configs/verbal_hard.json [-batch_sizes 1,16,100]
+           [-seq_len 50] [-n_steps 100] [-tolerance 1e-4]
+'''
+
+
+def make_inputs(hparams, agent_class, batch_size, seq_len, device):
+    nav_action = torch.randint(agent_class.n_input_nav_actions(), (batch_size,), device=device)
+    ask_action = torch.randint(agent_class.n_input_ask_actions(), (batch_size,), device=device)
+    feature = torch.randn(batch_size, hparams.img_feature_size, device=device)
+    h = tuple(torch.randn(hparams.num_lstm_layers, batch_size, hparams.hidden_size,
+        device=device) for _ in range(2))
+    ctx = torch.randn(batch_size, seq_len, hparams.hidden_size, device=device)
+    # Instructions of random lengths
+    lengths = torch.randint(1, seq_len + 1, (batch_size, 1), device=device)
+    ctx_mask = torch.arange(seq_len, device=device) >= lengths
+    nav_logit_mask = torch.arange(agent_class.n_output_nav_actions(), device=device) == \
+        agent_class.n_output_nav_actions() - 1
+    nav_logit_mask = nav_logit_mask.expand(batch_size, -1)
+    ask_logit_mask = torch.zeros(batch_size, agent_class.n_output_ask_actions(),
+        device=device) > 0
+    budget = torch.randint(hparams.max_ask_budget, (batch_size,), device=device)
+    cov = torch.randn(batch_size, seq_len, hparams.coverage_size, device=device) \
+        if hasattr(hparams, 'coverage_size') else None
+    return (nav_action, ask_action, feature, h, ctx, ctx_mask, nav_logit_mask,
+        ask_logit_mask), { 'budget': budget, 'cov': cov }
+
+def make_model(hparams, compile_decoder, device):
+    hparams = Namespace(**vars(hparams))
+    hparams.compile_decoder = compile_decoder
+    return AttentionSeq2SeqModel(100, hparams, device).to(device)
+
+def flatten(outputs):
+    flat = []
+    for x in outputs:
+        if isinstance(x, tuple):
+            flat.extend(flatten(x))
+        elif x is not None:
+            flat.append(x)
+    return flat
+
+def max_diff(xs, ys):
+    return max((x - y).abs().masked_fill(torch.isinf(x) & (x == y), 0).max().item()
+        for x, y in zip(xs, ys))
+
+def run_step(model, inputs, backward):
+    outputs = model.decode_cached(*inputs[0], **inputs[1])
+    if not backward:
+        return flatten(outputs), []
+    # nav_logit is -inf at the masked actions
+    new_h, alpha, nav_logit, nav_softmax, ask_softmax, new_cov, _ = outputs
+    loss = nav_logit.masked_fill(torch.isinf(nav_logit), 0).sum() + \
+        ask_softmax.log().sum() + new_h[0].sum() + alpha.sum()
+    if new_cov is not None:
+        loss = loss + new_cov.sum()
+    model.zero_grad()
+    loss.backward()
+    grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    return flatten(outputs), grads
+
+def check(hparams, agent_class, reference, model, device, tolerance):
+    ''' Largest differences from the eager model of the outputs in evaluation
+    mode and of the outputs and gradients in training mode. '''
+    inputs = make_inputs(hparams, agent_class, 16, 30, device)
+    diffs = []
+    for training in (False, True):
+        reference.train(training)
+        model.train(training)
+        with torch.set_grad_enabled(training):
+            expected = run_step(reference, inputs, training)
+            outputs = run_step(model, inputs, training)
+        diffs.append(max_diff(outputs[0], expected[0]))
+        if training:
+            diffs.append(max_diff(outputs[1], expected[1]))
+    ok = all(d <= tolerance for d in diffs)
+    print('%-8s eval outputs %.2e, train outputs %.2e, train grads %.2e: %s' % (
+        model.decoder.compile_decoder, diffs[0], diffs[1], diffs[2],
+        'OK' if ok else 'MISMATCH'))
+    return ok
+
+def benchmark(hparams, agent_class, models, batch_sizes, seq_len, n_steps, device):
+    print('\n*** %s, evaluation mode, steps/sec' % device)
+    print('%-8s' % 'batch' + ''.join('%12s' % name for name, _ in models))
+    for batch_size in batch_sizes:
+        inputs = make_inputs(hparams, agent_class, batch_size, seq_len, device)
+        rates = []
+        for _, model in models:
+            model.eval()
+            with torch.no_grad():
+                # Warm up (compilation, TorchScript profiling runs, allocator)
+                for _ in range(5):
+                    model.decode_cached(*inputs[0], **inputs[1])
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+                for _ in range(n_steps):
+                    model.decode_cached(*inputs[0], **inputs[1])
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+            rates.append(n_steps / (time.time() - start))
+        print('%-8d' % batch_size + ''.join('%12.1f' % r for r in rates))
+
+def main():
+    parser = make_parser()
+    parser.add_argument('-batch_sizes', type=str, default='1,16,100')
+    parser.add_argument('-seq_len', type=int, default=50)
+    parser.add_argument('-n_steps', type=int, default=100)
+    parser.add_argument('-tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    with open(args.config_file) as f:
+        hparams = Namespace(**json.load(f))
+    for flag in vars(args):
+        value = getattr(args, flag)
+        if value is not None:
+            setattr(hparams, flag, value)
+    # Dropout masks are not reproducible across compiled and eager code
+    hparams.dropout_ratio = 0
+
+    agent_class = VerbalAskAgent if 'verbal' in hparams.advisor else AskAgent
+    batch_sizes = [int(b) for b in hparams.batch_sizes.split(',')]
+
+    devices = [torch.device('cpu')]
+    if torch.cuda.is_available():
+        devices.append(torch.device('cuda'))
+    ok = True
+    for device in devices:
+        torch.manual_seed(0)
+        reference = make_model(hparams, 'none', device)
+        models = [('none', reference)]
+        print('\n*** %s, differences from the eager decode step' % device)
+        for compile_decoder in DECODER_COMPILERS[1:]:
+            model = make_model(hparams, compile_decoder, device)
+            model.load_state_dict(reference.state_dict())
+            ok &= check(hparams, agent_class, reference, model, device, hparams.tolerance)
+            models.append((compile_decoder, model))
+        benchmark(hparams, agent_class, models, batch_sizes, hparams.seq_len,
+            hparams.n_steps, device)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from __future__ import division
+
+import os
+import sys
+import json
+
+import torch
+
+from utils import Tokenizer, img_feature_dtypes
+from env import VNLABatch
+from model import AttentionSeq2SeqModel
+from ask_agent import AskAgent
+from verbal_ask_agent import VerbalAskAgent
+from eval import Evaluation
+from flags import make_parser
+
+'''
+Evaluate one trained checkpoint on val_seen/val_unseen with the image features
+stored as float32, float16 and int8 (see `-img_feature_dtype`) and report the
+metric deltas against float32, so the feature store can be chosen per deployment.
+
+Usage: python compare_feature_dtypes.py -config_file configs/verbal_hard.json \
+           -load_path [checkpoint] [-dtypes float32,float16,int8]
+'''
+
+REPORTED_METRICS = ['both_succeed_rate', 'first_success_rate', 'second_success_rate',
+    'oracle_rate', 'first_nav_error', 'second_nav_error', 'steps',
+    'original_success_rate', 'original_nav_errors']
+
+
+def evaluate(hparams, agent, tok, splits):
+    test_feedback = { 'nav' : 'argmax', 'ask' : 'argmax' }
+    train_env = VNLABatch(hparams, split='train', tokenizer=tok)
+    scores = {}
+    for split in splits:
+        torch.manual_seed(hparams.seed)
+        env = VNLABatch(hparams, split=split, tokenizer=tok,
+            from_train_env=train_env, traj_len_estimates=train_env.traj_len_estimates)
+        evaluator = Evaluation(hparams, [split], hparams.data_path)
+        traj = agent.test(env, test_feedback, use_dropout=False, allow_cheat=False)
+        agent.results_path = os.path.join(hparams.exp_dir, '%s_%s_%s.json' % (
+            hparams.model_prefix, split, hparams.img_feature_dtype))
+        agent.write_results(traj)
+        scores[split], _, _ = evaluator.score(agent.results_path)
+    return scores
+
+def main():
+    parser = make_parser()
+    parser.add_argument('-dtypes', type=str, default=','.join(img_feature_dtypes),
+        help='comma-separated image feature dtypes to compare')
+    args = parser.parse_args()
+
+    device = torch.device('cuda', args.device_id) if torch.cuda.is_available() \
+        else torch.device('cpu')
+    ckpt = torch.load(args.load_path, map_location=device)
+    hparams = ckpt['hparams']
+    with open(args.config_file) as f:
+        for flag, value in json.load(f).items():
+            if not hasattr(hparams, flag):
+                setattr(hparams, flag, value)
+    for flag in vars(args):
+        value = getattr(args, flag)
+        if value is not None:
+            setattr(hparams, flag, value)
+
+    DATA_DIR = os.getenv('PT_DATA_DIR', '../../../data')
+    hparams.data_path = os.path.join(DATA_DIR, hparams.data_dir)
+    hparams.img_features = os.path.join(DATA_DIR, 'img_features/ResNet-152-imagenet.tsv')
+    hparams.exp_dir = os.path.dirname(os.path.abspath(args.load_path))
+    hparams.model_prefix = os.path.basename(args.load_path).replace('.ckpt', '')
+
+    vocab = ckpt['vocab']
+    tok = Tokenizer(vocab=vocab, encoding_length=hparams.max_input_length)
+
+    model = AttentionSeq2SeqModel(len(vocab), hparams, device).to(device)
+    model.load_state_dict(ckpt['model_state_dict'])
+    if 'verbal' in hparams.advisor:
+        agent = VerbalAskAgent(model, hparams, device)
+    elif hparams.advisor == 'direct':
+        agent = AskAgent(model, hparams, device)
+    else:
+        sys.exit('%s advisor not supported' % hparams.advisor)
+
+    splits = ['val_seen', 'val_unseen']
+    dtypes = args.dtypes.split(',')
+    results = {}
+    for dtype in dtypes:
+        hparams.img_feature_dtype = dtype
+        results[dtype] = evaluate(hparams, agent, tok, splits)
+
+    base = dtypes[0]
+    print('')
+    print('Deltas are relative to %s' % base)
+    for split in splits:
+        print('\n*** %s' % split)
+        print('%-25s' % 'metric' + ''.join('%18s' % dtype for dtype in dtypes))
+        for metric in REPORTED_METRICS:
+            if metric not in results[base][split]:
+                continue
+            row = '%-25s' % metric
+            for dtype in dtypes:
+                val = results[dtype][split][metric]
+                delta = val - results[base][split][metric]
+                row += '%18s' % ('%.4f (%+.4f)' % (val, delta))
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import os
+import argparse
+
+from utils import convert_img_features, img_feature_dtypes
+
+'''
+One-time conversion of the ResNet image features TSV into a float32 .npy file
+plus a `scanId_viewpointId` index. `utils.load_img_features` picks up the
+cache automatically when it sits next to the TSV, and memory-maps it so that
+several training/evaluation jobs on one machine share the same page cache.
+Use `-dtype float16` or `-dtype int8` to also write a reduced precision cache
+for `-img_feature_dtype`.
+
+Usage: python convert_img_features.py [path to ResNet-152-imagenet.tsv] [-dtype float32|float16|int8]
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tsv_path', type=str, nargs='?',
+        default=os.path.join(os.getenv('PT_DATA_DIR', '../../../data'),
+            'img_features/ResNet-152-imagenet.tsv'),
+        help='path to the image features TSV')
+    parser.add_argument('-dtype', type=str, default='float32', choices=img_feature_dtypes,
+        help='storage type of the cache')
+    args = parser.parse_args()
+
+    cache_path, index_path = convert_img_features(args.tsv_path, dtype=args.dtype)
+    print('Wrote %s and %s' % (cache_path, index_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,10 +11,10 @@ import networkx as nx
 from collections import defaultdict
 import scipy.stats
 
-sys.path.append('../../build')
-import MatterSim
-
 from oracle import make_oracle
+from path_cache import load_shortest_paths
+from simulator import make_simulator, load_batched_nav_tables, SimState, \
+    discretize_view, view_heading, view_elevation
 from utils import load_datasets, load_nav_graphs
 import utils
 
@@ -23,7 +23,15 @@ csv.field_size_limit(sys.maxsize)
 
 class EnvBatch():
 
-    def __init__(self, from_train_env=None, img_features=None, batch_size=100):
+    def __init__(self, from_train_env=None, img_features=None, batch_size=100,
+                 img_feature_dtype='float32', simulator='mattersim'):
+        self._init_features(from_train_env, img_features, img_feature_dtype)
+        self.sims = []
+        for i in range(batch_size):
+            sim = make_simulator(simulator, self.image_w, self.image_h, self.vfov)
+            self.sims.append(sim)
+
+    def _init_features(self, from_train_env, img_features, img_feature_dtype):
         if from_train_env is not None:
             self.features = from_train_env.features
             self.image_h  = from_train_env.image_h
@@ -31,24 +39,13 @@ class EnvBatch():
             self.vfov     = from_train_env.vfov
         elif img_features is not None:
             self.image_h, self.image_w, self.vfov, self.features = \
-                utils.load_img_features(img_features)
+                utils.load_img_features(img_features, dtype=img_feature_dtype)
         else:
             print('Image features not provided')
             self.features = None
             self.image_w = 640
             self.image_h = 480
             self.vfov = 60
-        self.sims = []
-        for i in range(batch_size):
-            sim = MatterSim.Simulator()
-            sim.setRenderingEnabled(False)
-            sim.setDiscretizedViewingAngles(True)
-            sim.setCameraResolution(self.image_w, self.image_h)
-            sim.setCameraVFOV(math.radians(self.vfov))
-            sim.setNavGraphPath(
-                os.path.join(os.getenv('PT_DATA_DIR', '../../../data'), 'connectivity'))
-            sim.init()
-            self.sims.append(sim)
 
     def _make_id(self, scanId, viewpointId):
         return scanId + '_' + viewpointId
@@ -63,7 +60,7 @@ class EnvBatch():
             state = sim.getState()
             long_id = self._make_id(state.scanId, state.location.viewpointId)
             if self.features:
-                feature = self.features[long_id][state.viewIndex,:]
+                feature = self.features.view(long_id, state.viewIndex)
                 feature_states.append((feature, state))
             else:
                 feature_states.append((None, state))
@@ -74,13 +71,166 @@ class EnvBatch():
             self.sims[i].makeAction(index, heading, elevation)
 
 
+class BatchedEnvBatch(EnvBatch):
+    ''' EnvBatch backed by the GraphSimulator tables that keeps the state of
+    the whole batch as NumPy arrays (global viewpoint index, view index, step)
+    and steps it with vectorized table lookups. Each step rebinds the arrays
+    instead of writing into them, so a BatchState stays a valid snapshot. '''
+
+    def __init__(self, from_train_env=None, img_features=None, batch_size=100,
+                 img_feature_dtype='float32'):
+        self._init_features(from_train_env, img_features, img_feature_dtype)
+        self.tables = load_batched_nav_tables(
+            hfov=math.radians(self.vfov) * self.image_w / self.image_h)
+        self.feature_rows = np.zeros(0, dtype=np.int64)
+        self.viewpoint = np.zeros(batch_size, dtype=np.int64)
+        self.view_index = np.zeros(batch_size, dtype=np.int64)
+        self.step = np.zeros(batch_size, dtype=np.int64)
+
+    def add_scans(self, scans):
+        self.tables.add_scans(scans)
+        n_viewpoints = len(self.tables.viewpoint_ids)
+        if self.features and len(self.feature_rows) < n_viewpoints:
+            new_rows = [self.features.index[self._make_id(
+                self.tables.scans[self.tables.viewpoint_scan[g]], self.tables.viewpoint_ids[g])]
+                for g in range(len(self.feature_rows), n_viewpoints)]
+            self.feature_rows = np.concatenate([self.feature_rows,
+                np.array(new_rows, dtype=np.int64)])
+
+    def newEpisodes(self, scanIds, viewpointIds, headings):
+        self.add_scans(scanIds)
+        self.viewpoint = np.array([self.tables.global_index(scanId, viewpointId)
+            for scanId, viewpointId in zip(scanIds, viewpointIds)], dtype=np.int64)
+        self.view_index = np.array([discretize_view(heading, 0) for heading in headings],
+            dtype=np.int64)
+        self.step = np.zeros(len(scanIds), dtype=np.int64)
+
+    def get_state(self):
+        return BatchState(self, self.viewpoint, self.view_index, self.step)
+
+    def get_features(self, viewpoint, view_index):
+        if not self.features:
+            return None
+        return self.features.views(self.feature_rows[viewpoint], view_index)
+
+    def getStates(self):
+        state = self.get_state()
+        return [(state.get(i, 'feature'), state.sim_state(i)) for i in range(len(self.viewpoint))]
+
+    def makeActions(self, actions):
+        actions = np.asarray(actions, dtype=np.int64).reshape(-1, 3)
+        self.viewpoint, self.view_index = self.tables.transition(
+            self.viewpoint, self.view_index, actions)
+        self.step = self.step + 1
+
+
+class BatchState(object):
+    ''' Snapshot of the arrays of a BatchedEnvBatch. `get` materializes one
+    simulator field of one agent. '''
+
+    def __init__(self, env, viewpoint, view_index, step):
+        self.env = env
+        self.viewpoint = viewpoint
+        self.view_index = view_index
+        self.step = step
+
+    def nav_count(self):
+        return self.env.tables.nav_count[self.viewpoint, self.view_index]
+
+    def heading(self):
+        return view_heading(self.view_index)
+
+    def features(self):
+        return self.env.get_features(self.viewpoint, self.view_index)
+
+    def get(self, i, key):
+        g = self.viewpoint[i]
+        v = int(self.view_index[i])
+        if key == 'viewpoint':
+            return self.env.tables.viewpoint_ids[g]
+        if key == 'point':
+            return self.env.tables.points[g]
+        if key == 'viewIndex':
+            return v
+        if key == 'heading':
+            return view_heading(v)
+        if key == 'elevation':
+            return view_elevation(v)
+        if key == 'step':
+            return int(self.step[i])
+        if key == 'navigableLocations':
+            return self.env.tables.navigable_locations(g, v)
+        if key == 'feature':
+            if not self.env.features:
+                return None
+            return self.env.features.views(self.env.feature_rows[[g]], [v])[0]
+        raise KeyError(key)
+
+    def sim_state(self, i):
+        locations = self.get(i, 'navigableLocations')
+        return SimState(self.env.tables.scans[self.env.tables.viewpoint_scan[self.viewpoint[i]]],
+            self.get(i, 'step'), locations[0], self.get(i, 'viewIndex'),
+            self.get(i, 'heading'), self.get(i, 'elevation'), locations)
+
+
+class BatchedObservation(dict):
+    ''' Observation of one agent of a BatchedEnvBatch; simulator fields are
+    read from the BatchState on first access. '''
+
+    def __init__(self, state, i, *args, **kwargs):
+        super(BatchedObservation, self).__init__(*args, **kwargs)
+        self.state = state
+        self.i = i
+
+    def __missing__(self, key):
+        value = self.state.get(self.i, key)
+        self[key] = value
+        return value
+
+
+class BatchedObservations(object):
+    ''' Observations of a whole batch. `state` exposes them as arrays;
+    the per-agent dicts are only built when indexed. '''
+
+    def __init__(self, state, make_ob, batch_size):
+        self.state = state
+        self._make_ob = make_ob
+        self._obs = [None] * batch_size
+
+    def __len__(self):
+        return len(self._obs)
+
+    def __getitem__(self, i):
+        if self._obs[i] is None:
+            self._obs[i] = self._make_ob(self.state, i)
+        return self._obs[i]
+
+    def __iter__(self):
+        for i in range(len(self._obs)):
+            yield self[i]
+
+    def materialized(self):
+        return [(i, ob) for i, ob in enumerate(self._obs) if ob is not None]
+
+
 class VNLABatch():
 
     def __init__(self, hparams, split=None, tokenizer=None, from_train_env=None,
                  traj_len_estimates=None):
-        self.env = EnvBatch(
-            from_train_env=from_train_env.env if from_train_env is not None else None,
-            img_features=hparams.img_features, batch_size=hparams.batch_size)
+        self.batched = hasattr(hparams, 'batched_env') and hparams.batched_env
+        img_feature_dtype = hparams.img_feature_dtype \
+            if hasattr(hparams, 'img_feature_dtype') else 'float32'
+        if self.batched:
+            self.env = BatchedEnvBatch(
+                from_train_env=from_train_env.env if from_train_env is not None else None,
+                img_features=hparams.img_features, batch_size=hparams.batch_size,
+                img_feature_dtype=img_feature_dtype)
+        else:
+            self.env = EnvBatch(
+                from_train_env=from_train_env.env if from_train_env is not None else None,
+                img_features=hparams.img_features, batch_size=hparams.batch_size,
+                img_feature_dtype=img_feature_dtype,
+                simulator=hparams.simulator if hasattr(hparams, 'simulator') else 'mattersim')
 
         self.random = random
         self.random.seed(hparams.seed)
@@ -139,6 +289,11 @@ class VNLABatch():
             sys.exit('No tokenizer!')
         return self.tokenizer.encode_sentence(instr)
 
+    def encode_batch(self, instruction_words):
+        if self.tokenizer is None:
+            sys.exit('No tokenizer!')
+        return self.tokenizer.encode_batch(instruction_words)
+
     def load_data(self, data):
         self.data = []
         self.scans = set()
@@ -152,8 +307,15 @@ class VNLABatch():
             new_item = dict(item)
             self.data.append(new_item)
 
+            # Tokenize each base instruction once
+            if self.tokenizer is not None:
+                self.tokenizer.encode_words(item['instruction'])
+
         self.reset_epoch()
 
+        if self.batched:
+            self.env.add_scans(self.scans)
+
         if self.split is not None:
             print('VNLABatch loaded with %d instructions, using split: %s' % (
                 len(self.data), self.split))
@@ -178,6 +340,8 @@ class VNLABatch():
         self.ix = 0
 
     def _get_obs(self, prev_obs=None):
+        if self.batched:
+            return self._get_batched_obs(prev_obs)
         obs = []
         for i, (feature, state) in enumerate(self.env.getStates()):
             item = self.batch[i]
@@ -203,6 +367,7 @@ class VNLABatch():
                 'step' : state.step,
                 'navigableLocations' : state.navigableLocations,
                 'instruction' : self.instructions[i],
+                'instruction_words' : self.instruction_words[i],
                 'goal_viewpoints': goal_viewpoints, # NOTE: this will be changed to second_goal_viewpoints after reaching 
                 'init_viewpoint' : item['start_viewpoint'] # NOTE: changed here
             })
@@ -214,8 +379,119 @@ class VNLABatch():
             obs[-1]['traj_len'] = self.traj_lens[i]
             if 'instr_encoding' in item:
                 obs[-1]['instr_encoding'] = item['instr_encoding']
+            obs[-1]['path_distances'] = self.path_distances[i]
+        return obs
+
+    def _reset_goal_state(self):
+        ''' Goal bookkeeping of the batched environment. '''
+        self.is_multi_priority = np.array(['first_goal_viewpoints' in item
+            for item in self.batch])
+        self.reached_first_goal = np.zeros(self.batch_size, dtype=bool)
+        self.goal_viewpoints = [item['first_goal_viewpoints']
+            if 'first_goal_viewpoints' in item else item['goal_viewpoints']
+            for item in self.batch]
+        self.first_goal_index = self._goal_index_array(
+            [item.get('first_goal_viewpoints', []) for item in self.batch])
+        self.goal_index = self._goal_index_array(self.goal_viewpoints)
+
+    def _goal_index_array(self, goal_viewpoints):
+        ''' Global viewpoint indices of goal sets, padded with -1. '''
+        goal_index = -np.ones((len(self.batch), max(1, max(map(len, goal_viewpoints)))),
+            dtype=np.int64)
+        for i, goals in enumerate(goal_viewpoints):
+            self._set_goal_index(goal_index, i, goals)
+        return goal_index
+
+    def _set_goal_index(self, goal_index, i, goals):
+        goal_index[i] = -1
+        goal_index[i, :len(goals)] = [self.env.tables.global_index(self.batch[i]['scan'], goal)
+            for goal in goals]
+
+    def _sync_goal_state(self, prev_obs):
+        ''' Pick up goal changes made to observation dicts (e.g. by the advisor). '''
+        if isinstance(prev_obs, BatchedObservations):
+            obs = prev_obs.materialized()
+        else:
+            obs = enumerate(prev_obs)
+        for i, ob in obs:
+            if 'first_goal_viewpoints' in ob:
+                if ob['goal_viewpoints'] is not self.goal_viewpoints[i]:
+                    self.goal_viewpoints[i] = ob['goal_viewpoints']
+                    self._update_goal_index(i)
+                self.reached_first_goal[i] = ob['reached_first_goal']
+
+    def _update_goal_index(self, i):
+        goals = self.goal_viewpoints[i]
+        if len(goals) > self.goal_index.shape[1]:
+            self.goal_index = np.pad(self.goal_index,
+                ((0, 0), (0, len(goals) - self.goal_index.shape[1])),
+                'constant', constant_values=-1)
+        self._set_goal_index(self.goal_index, i, goals)
+
+    def _update_goal_state(self):
+        ''' Switch to the second goals after reaching a first goal. '''
+        reached = (self.env.viewpoint[:, None] == self.first_goal_index).any(axis=1) & \
+            self.is_multi_priority & ~self.reached_first_goal
+        for i in np.nonzero(reached)[0]:
+            self.reached_first_goal[i] = True
+            self.goal_viewpoints[i] = self.batch[i]['second_goal_viewpoints']
+            self._update_goal_index(i)
+
+    def _get_batched_obs(self, prev_obs=None):
+        if prev_obs is not None:
+            self._sync_goal_state(prev_obs)
+        instructions = list(self.instructions)
+        instruction_words = list(self.instruction_words)
+        goal_viewpoints = list(self.goal_viewpoints)
+        goal_index = self.goal_index.copy()
+        reached_first_goal = self.reached_first_goal.copy()
+
+        def make_ob(state, i):
+            item = self.batch[i]
+            ob = BatchedObservation(state, i, {
+                'instr_id' : item['instr_id'],
+                'scan' : item['scan'],
+                'instruction' : instructions[i],
+                'instruction_words' : instruction_words[i],
+                'goal_viewpoints': goal_viewpoints[i],
+                'init_viewpoint' : item['start_viewpoint']
+            })
+            if 'first_goal_viewpoints' in item: # multi-priority task
+                ob['first_goal_viewpoints'] = item['first_goal_viewpoints']
+                ob['second_goal_viewpoints'] = item['second_goal_viewpoints']
+                ob['reached_first_goal'] = bool(reached_first_goal[i])
+            ob['max_queries'] = self.max_queries_constraints[i]
+            ob['traj_len'] = self.traj_lens[i]
+            if 'instr_encoding' in item:
+                ob['instr_encoding'] = item['instr_encoding']
+            ob['path_distances'] = self.path_distances[i]
+            return ob
+
+        obs = BatchedObservations(self.env.get_state(), make_ob, len(self.batch))
+        # Goals as global viewpoint indices, for the batched teacher
+        obs.goal_viewpoints = goal_viewpoints
+        obs.goal_index = goal_index
         return obs
 
+    def _compute_path_distances(self):
+        ''' For each episode and goal, the distance from every viewpoint of the
+        scan to the shortest path from the start to that goal, indexed like
+        the scan's ShortestPaths. The ask teacher's deviation rule looks the
+        current viewpoint up here instead of searching the path every step. '''
+        self.path_distances = []
+        for item in self.batch:
+            shortest_paths = load_shortest_paths(item['scan'])
+            goals = item.get('goal_viewpoints', []) + \
+                item.get('first_goal_viewpoints', []) + item.get('second_goal_viewpoints', [])
+            path_distances = {}
+            for goal in goals:
+                if goal not in path_distances and np.isfinite(
+                        shortest_paths.distance(item['start_viewpoint'], goal)):
+                    path = [shortest_paths.index[viewpoint] for viewpoint in
+                        shortest_paths.path(item['start_viewpoint'], goal)]
+                    path_distances[goal] = shortest_paths.distances[:, path].min(axis=1)
+            self.path_distances.append(path_distances)
+
     def _calculate_max_queries(self, traj_len):
         ''' Sample a help-requesting budget given a time budget. '''
 
@@ -233,7 +509,13 @@ class VNLABatch():
         viewpointIds = [item['start_viewpoint'] for item in self.batch]
         headings = [item['initial_heading'] for item in self.batch]
         self.instructions = [item['instruction'] for item in self.batch]
+        self.base_instruction_words = [self.tokenizer.encode_words(item['instruction'])
+            if self.tokenizer is not None else None for item in self.batch]
+        self.instruction_words = list(self.base_instruction_words)
         self.env.newEpisodes(scanIds, viewpointIds, headings)
+        if self.batched:
+            self._reset_goal_state()
+        self._compute_path_distances()
 
         self.max_queries_constraints = [None] * self.batch_size
         self.traj_lens = [None] * self.batch_size
@@ -258,6 +540,12 @@ class VNLABatch():
         return self._get_obs()
 
     def step(self, actions, prev_obs):
+        if self.batched:
+            self._sync_goal_state(prev_obs)
+            self.env.makeActions(actions)
+            self._update_goal_state()
+            return self._get_batched_obs()
+
         self.env.makeActions(actions)
         # NOTE: changed here
         obs = self._get_obs(prev_obs)
@@ -279,10 +567,22 @@ class VNLABatch():
 
         return obs
 
-    def prepend_instruction(self, idx, instr):
-        ''' Prepend subgoal to end-goal. '''
+    def prepend_instruction(self, idx, instr, words=None):
+        ''' Prepend subgoal to end-goal. `words` optionally gives the token ids
+        of the subgoal and the '.' separator (see StepByStepSubgoalOracle.subgoal_words). '''
 
         self.instructions[idx] = instr + ' . ' + self.batch[idx]['instruction']
+        if self.tokenizer is None:
+            return
+        # Splice the tokenized subgoal in front of the tokenized base instruction
+        if words is not None:
+            self.instruction_words[idx] = words + self.base_instruction_words[idx]
+        elif self.tokenizer.split_by_spaces:
+            self.instruction_words[idx] = self.tokenizer.encode_words(instr) + \
+                self.tokenizer.encode_words('.') + self.base_instruction_words[idx]
+        else:
+            self.instruction_words[idx] = self.tokenizer.encode_words(
+                self.instructions[idx], cache=False)
 
     def get_obs(self, prev_obs):
         return self._get_obs(prev_obs)
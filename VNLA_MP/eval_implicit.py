@@ -7,7 +7,8 @@ import numpy as np
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
-from utils import load_datasets, load_nav_graphs, load_region_label_to_name, load_panos_to_region
+from utils import load_datasets, load_region_label_to_name, load_panos_to_region
+from path_cache import load_scans
 
 '''
 This script is a duplicate of eval.py, modified to evaluate tasks with no explicit ordering of priority.
@@ -20,7 +21,6 @@ class Evaluation(object):
         self.splits = splits
 
         self.scans = set()
-        self.graphs = {}
         self.distances = {}
 
         self.no_room = hasattr(hparams, 'no_room') and hparams.no_room
@@ -50,16 +50,14 @@ class Evaluation(object):
 
         new_scans = set.difference(scans, self.scans)
         if new_scans:
-            for scan in new_scans:
-                self.graphs[scan] = load_nav_graphs(scan)
-                self.distances[scan] = dict(nx.all_pairs_dijkstra_path_length(self.graphs[scan]))
+            self.distances.update(load_scans(new_scans))
         self.scans.update(new_scans)
 
     def _get_nearest(self, scan, goal_id, path):
         near_id = path[0][0]
-        near_d = self.distances[scan][near_id][goal_id]
+        near_d = self.distances[scan].distance(near_id, goal_id)
         for item in path:
-            d = self.distances[scan][item[0]][goal_id]
+            d = self.distances[scan].distance(item[0], goal_id)
             if d < near_d:
                 near_id = item[0]
                 near_d = d
@@ -81,7 +79,7 @@ class Evaluation(object):
                 assert start == path[0][0], 'Result trajectories should include the start position'
                 goal = shortest_path[-1]
                 final_pos = path[-1][0]
-                original_nav_errors = min(original_nav_errors, self.distances[scan][final_pos][goal])
+                original_nav_errors = min(original_nav_errors, self.distances[scan].distance(final_pos, goal))
             
             self.scores['original_nav_errors'].append(original_nav_errors)
             self.scores['combined_nav_errors'].append(original_nav_errors) # for both tasks!
@@ -89,7 +87,7 @@ class Evaluation(object):
             distance = 0
             prev = path[0]
             for curr in path[1:]:
-                distance += self.distances[scan][prev[0]][curr[0]]
+                distance += self.distances[scan].distance(prev[0], curr[0])
                 prev = curr
             self.scores['original_trajectory_lengths'].append(distance)
             self.scores['original_trajectory_steps'].append(len(path) - 1)
@@ -117,7 +115,7 @@ class Evaluation(object):
             first_goal_pos = None
             for goal in gt['first_goal_viewpoints']:
                 nearest_pos = self._get_nearest(scan, goal, path)
-                d = self.distances[scan][nearest_pos][goal]
+                d = self.distances[scan].distance(nearest_pos, goal)
                 if d < first_nav_errors:
                     first_nav_errors = d
                     first_goal_pos = nearest_pos
@@ -126,8 +124,8 @@ class Evaluation(object):
             final_pos = path[-1][0]
             for goal in gt['second_goal_viewpoints']:
                 nearest_pos = self._get_nearest(scan, goal, path)
-                second_nav_errors = min(second_nav_errors, self.distances[scan][final_pos][goal])
-                oracle_errors = min(oracle_errors, self.distances[scan][nearest_pos][goal])
+                second_nav_errors = min(second_nav_errors, self.distances[scan].distance(final_pos, goal))
+                oracle_errors = min(oracle_errors, self.distances[scan].distance(nearest_pos, goal))
 
             self.scores['first_nav_errors'].append(first_nav_errors) # assuming order is correctly executed by agent
             self.scores['second_nav_errors'].append(second_nav_errors) # assuming order is correctly executed by agent
@@ -137,7 +135,7 @@ class Evaluation(object):
             # For second goal (reached first)
             for goal in gt['second_goal_viewpoints']:
                 nearest_pos = self._get_nearest(scan, goal, path)
-                d = self.distances[scan][nearest_pos][goal]
+                d = self.distances[scan].distance(nearest_pos, goal)
                 if d < wrong_second_nav_errors:
                     wrong_second_nav_errors = d
 
@@ -145,7 +143,7 @@ class Evaluation(object):
             final_pos = path[-1][0]
             for goal in gt['first_goal_viewpoints']:
                 nearest_pos = self._get_nearest(scan, goal, path)
-                wrong_first_nav_errors = min(wrong_first_nav_errors, self.distances[scan][final_pos][goal])
+                wrong_first_nav_errors = min(wrong_first_nav_errors, self.distances[scan].distance(final_pos, goal))
 
             self.scores['wrong_first_nav_errors'].append(wrong_first_nav_errors)
             self.scores['wrong_second_nav_errors'].append(wrong_second_nav_errors)     
@@ -160,7 +158,7 @@ class Evaluation(object):
             distance = 0
             prev = path[0]
             for curr in path[1:]:
-                distance += self.distances[scan][prev[0]][curr[0]]
+                distance += self.distances[scan].distance(prev[0], curr[0])
                 prev = curr
             self.scores['trajectory_lengths'].append(distance)
 
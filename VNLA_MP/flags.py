@@ -20,6 +20,8 @@ def make_parser():
         help='path to pretrained image embeddings')
    parser.add_argument('-img_feature_size', type=int, default=2048,
         help='image embedding size')
+   parser.add_argument('-img_feature_dtype', type=str,
+        help="storage type of image features ('float32', 'float16' or 'int8')")
    parser.add_argument('-max_input_length', type=int,
         help='maximum input instruction length')
    parser.add_argument('-batch_size', type=int,
@@ -77,6 +79,12 @@ def make_parser():
         help='number of next actions suggested by a subgoal')
    parser.add_argument('-subgoal_vocab', type=str,
         help='subgoal vocabulary')
+   parser.add_argument('-subgoal_cache_size', type=int,
+        help='number of verbal subgoals kept in the advisor LRU cache (0 disables it)')
+   parser.add_argument('-precompute_subgoals', type=int,
+        help='fill the subgoal cache along the teacher paths of all splits before training')
+   parser.add_argument('-index_teacher_trajectories', type=int,
+        help='index the teacher actions along the teacher trajectories of all splits before training')
 
    # Help-requesting teacher hyperparameters
    parser.add_argument('--deviate_threshold', type=float)
@@ -94,6 +102,18 @@ def make_parser():
    parser.add_argument('-backprop_softmax', type=int, default=1)
    parser.add_argument('-backprop_ask_features', type=int)
 
+   # Coverage
+   parser.add_argument('-coverage_impl', type=str,
+        help="coverage GRU implementation: 'matmul' (default), 'script' (TorchScript) or 'gru' (nn.GRU)")
+
+   # Compiled decode step
+   parser.add_argument('-compile_decoder', type=str,
+        help="'script' (TorchScript attention) or 'compile' (torch.compile of the whole step); eager by default")
+
+   # Mixed precision
+   parser.add_argument('-amp', type=int,
+        help='run rollouts under autocast (fp16 with loss scaling on GPU, bfloat16 on CPU)')
+
    # Budget Features
    parser.add_argument('-max_ask_budget', type=int, default=20,
         help='budget upperbound')
@@ -105,10 +125,20 @@ def make_parser():
         help='evaluate with multiple seeds (automatically set -eval_only 1)')
    parser.add_argument('-teacher_interpret', type=int,
         help='0 = evaluate with indirect advisor    1 = evaluate with direct advisor')
+   parser.add_argument('-quantize', type=int,
+        help='evaluate with int8 dynamic quantization of the LSTM and Linear layers (needs -device cpu)')
 
    # Others
    parser.add_argument('-device_id', type=int, default=0,
         help='gpu id')
+   parser.add_argument('-device', type=str,
+        help="'cuda' (default) or 'cpu', e.g. to evaluate on nodes without a GPU")
+   parser.add_argument('-num_threads', type=int,
+        help='number of intra-op threads on CPU (default: set by torch)')
+   parser.add_argument('-simulator', type=str,
+        help="simulator backend ('mattersim' or 'graph', which needs no C++ build)")
+   parser.add_argument('-batched_env', type=int,
+        help='step the whole batch with vectorized lookups over the graph simulator tables')
    parser.add_argument('-no_room', type=int,
         help='train or evaluate with the no_room dataset (when using this, set -data_dir noroom)')
 
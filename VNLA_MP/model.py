@@ -70,9 +70,59 @@ class EncoderLSTM(nn.Module):
         return ctx, state
 
 
+def coverage_gru(context, h, attn, cov, weight_ih, weight_hh, bias_ih, bias_hh):
+    ''' One step of the coverage GRU of every (agent, token), i.e. nn.GRU on
+    the input [context, h, attn] with hidden state cov, computed as batched
+    matmuls over the (batch, seq_len, .) tensors. The input weights are split
+    by input, so that the part of h is computed once per agent rather than
+    once per token. '''
+    dim = context.size(2)
+    gi = F.linear(context, weight_ih[:, :dim], bias_ih) + \
+        F.linear(h, weight_ih[:, dim:2 * dim]).unsqueeze(1) + \
+        attn.unsqueeze(2) * weight_ih[:, 2 * dim]
+    gh = F.linear(cov, weight_hh, bias_hh)
+    i_r, i_z, i_n = gi.chunk(3, 2)
+    h_r, h_z, h_n = gh.chunk(3, 2)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return n + z * (cov - n)
+
+# TorchScript version, fusing the elementwise gate math; None if scripting
+# is not supported by the installed torch
+try:
+    scripted_coverage_gru = torch.jit.script(coverage_gru)
+except Exception:
+    scripted_coverage_gru = None
+
+COVERAGE_IMPLS = ['gru', 'matmul', 'script']
+
+
+def attend(h, context, mask, linear_in_weight, linear_out_weight):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor) -> Tuple[Tensor, Tensor]
+    ''' Attention.forward without coverage, as a function of the weights so
+    that it can be scripted. '''
+    target = F.linear(h, linear_in_weight).unsqueeze(2)  # batch x dim x 1
+    attn = torch.bmm(context, target).squeeze(2).float()  # batch x seq_len
+    attn = F.softmax(attn.masked_fill(mask, -float('inf')), dim=1)
+    weighted_context = torch.bmm(attn.unsqueeze(1), context).squeeze(1)  # batch x dim
+    h_tilde = torch.tanh(F.linear(torch.cat((weighted_context, h), 1), linear_out_weight))
+    return h_tilde, attn
+
+try:
+    scripted_attend = torch.jit.script(attend)
+except Exception:
+    scripted_attend = None
+
+# Ways of compiling the decode step (see AskAttnDecoderLSTM): 'script' runs
+# the attention (and coverage GRU) as TorchScript, 'compile' compiles the
+# whole step with torch.compile
+DECODER_COMPILERS = ['none', 'script', 'compile']
+
+
 class Attention(nn.Module):
 
-    def __init__(self, dim, coverage_dim=None):
+    def __init__(self, dim, coverage_dim=None, coverage_impl='matmul', script=False):
         super(Attention, self).__init__()
         self.linear_in = nn.Linear(dim, dim, bias=False)
         self.sm = nn.Softmax(dim=1)
@@ -81,15 +131,27 @@ class Attention(nn.Module):
         if coverage_dim is not None:
             self.cov_rnn = nn.GRU(dim * 2 + 1, coverage_dim, 1)
             self.cov_linear = nn.Linear(coverage_dim, dim)
+        assert coverage_impl in COVERAGE_IMPLS
+        if coverage_impl == 'script' and scripted_coverage_gru is None:
+            print('TorchScript is not available, falling back to the matmul coverage GRU')
+            coverage_impl = 'matmul'
+        self.coverage_impl = coverage_impl
+        if script and (scripted_attend is None or scripted_coverage_gru is None):
+            print('TorchScript is not available, falling back to eager attention')
+            script = False
+        self.script = script
 
     def forward(self, h, context, mask=None, cov=None):
+        if self.script and mask is not None:
+            return self._forward_scripted(h, context, mask, cov=cov)
+
         target = self.linear_in(h).unsqueeze(2)  # batch x dim x 1
 
         if cov is not None:
             context = context + self.cov_linear(cov)
 
-        # Get attention
-        attn = torch.bmm(context, target).squeeze(2)  # batch x seq_len
+        # Get attention (in fp32 under autocast, for the -inf masking)
+        attn = torch.bmm(context, target).squeeze(2).float()  # batch x seq_len
         if mask is not None:
             # -Inf masking prior to the softmax
             attn.data.masked_fill_(mask, -float('inf'))
@@ -102,7 +164,12 @@ class Attention(nn.Module):
         h_tilde = self.tanh(self.linear_out(h_tilde))
 
         # Update coverage vector
-        if hasattr(self, 'cov_rnn') and hasattr(self, 'cov_linear'):
+        if hasattr(self, 'cov_rnn') and hasattr(self, 'cov_linear') and \
+                self.coverage_impl != 'gru':
+            gru = coverage_gru if self.coverage_impl == 'matmul' else scripted_coverage_gru
+            new_cov = gru(context, h, attn, cov, self.cov_rnn.weight_ih_l0,
+                self.cov_rnn.weight_hh_l0, self.cov_rnn.bias_ih_l0, self.cov_rnn.bias_hh_l0)
+        elif hasattr(self, 'cov_rnn') and hasattr(self, 'cov_linear'):
             cov_expand = cov.view(-1, cov.size(2))
             context_expand = context.view(-1, context.size(2))
             h_expand = h.unsqueeze(1).expand(-1, cov.size(1), -1).contiguous().view(-1, h.size(1))
@@ -115,6 +182,21 @@ class Attention(nn.Module):
 
         return h_tilde, attn, new_cov
 
+    def _forward_scripted(self, h, context, mask, cov=None):
+        if cov is not None:
+            context = context + self.cov_linear(cov)
+
+        h_tilde, attn = scripted_attend(h, context, mask,
+            self.linear_in.weight, self.linear_out.weight)
+
+        if hasattr(self, 'cov_rnn') and hasattr(self, 'cov_linear'):
+            new_cov = scripted_coverage_gru(context, h, attn, cov, self.cov_rnn.weight_ih_l0,
+                self.cov_rnn.weight_hh_l0, self.cov_rnn.bias_ih_l0, self.cov_rnn.bias_hh_l0)
+        else:
+            new_cov = None
+
+        return h_tilde, attn, new_cov
+
 
 class AskAttnDecoderLSTM(nn.Module):
 
@@ -124,6 +206,18 @@ class AskAttnDecoderLSTM(nn.Module):
 
         self.device = device
 
+        self.compile_decoder = hparams.compile_decoder \
+            if hasattr(hparams, 'compile_decoder') else 'none'
+        assert self.compile_decoder in DECODER_COMPILERS
+        self.compiled_step = None
+        if self.compile_decoder == 'compile':
+            if hasattr(torch, 'compile'):
+                # Batch size and instruction length change between calls
+                self.compiled_step = torch.compile(self._decode_step, dynamic=True)
+            else:
+                print('torch.compile is not available, falling back to the eager decode step')
+                self.compile_decoder = 'none'
+
         self.nav_embedding = nn.Embedding(agent_class.n_input_nav_actions(),
                                           hparams.nav_embed_size, padding_idx=padding_idx)
         self.ask_embedding = nn.Embedding(agent_class.n_input_ask_actions(),
@@ -142,7 +236,10 @@ class AskAttnDecoderLSTM(nn.Module):
 
         self.attention_layer = Attention(hparams.hidden_size,
                                          coverage_dim=hparams.coverage_size
-                                         if hasattr(hparams, 'coverage_size') else None)
+                                         if hasattr(hparams, 'coverage_size') else None,
+                                         coverage_impl=hparams.coverage_impl
+                                         if hasattr(hparams, 'coverage_impl') else 'matmul',
+                                         script=self.compile_decoder == 'script')
 
         self.nav_predictor = nn.Linear(hparams.hidden_size, agent_class.n_output_nav_actions())
 
@@ -200,11 +297,47 @@ class AskAttnDecoderLSTM(nn.Module):
                 nav_logit_mask, ask_logit_mask,
                 budget=None, cov=None):
 
+        return self.forward_cached(nav_action, ask_action, feature, h, ctx, ctx_mask,
+            nav_logit_mask, ask_logit_mask, budget=budget, cov=cov)[:-1]
+
+    def forward_nav(self, nav_action, ask_action, feature, h, ctx, ctx_mask,
+                    nav_logit_mask, budget=None, cov=None):
+
         h_tilde, alpha, output_drop, new_h, new_cov = self._lstm_and_attend(
             nav_action, ask_action, feature, h, ctx, ctx_mask, budget=budget, cov=cov)
 
-        # Predict nav action.
-        nav_logit = self.nav_predictor(h_tilde)
+        # Predict nav action (logits in fp32 under autocast, for the -inf masking)
+        nav_logit = self.nav_predictor(h_tilde).float()
+        nav_logit.data.masked_fill_(nav_logit_mask, -float('inf'))
+        nav_softmax = F.softmax(nav_logit, dim=1)
+
+        return new_h, alpha, nav_logit, nav_softmax, new_cov
+
+    def forward_cached(self, nav_action, ask_action, feature, h, ctx, ctx_mask,
+                       nav_logit_mask, ask_logit_mask, budget=None, cov=None):
+        ''' forward, also returning the LSTM and attention outputs of the step
+        for forward_nav_rows. '''
+
+        args = (nav_action, ask_action, feature, h, ctx, ctx_mask,
+            nav_logit_mask, ask_logit_mask, budget, cov)
+        if self.compiled_step is not None:
+            try:
+                return self.compiled_step(*args)
+            except Exception as e:
+                print('torch.compile failed (%s), falling back to the eager decode step' % e)
+                self.compiled_step = None
+                self.compile_decoder = 'none'
+        return self._decode_step(*args)
+
+    def _decode_step(self, nav_action, ask_action, feature, h, ctx, ctx_mask,
+                     nav_logit_mask, ask_logit_mask, budget, cov):
+
+        step = self._lstm_and_attend(
+            nav_action, ask_action, feature, h, ctx, ctx_mask, budget=budget, cov=cov)
+        h_tilde, alpha, output_drop, new_h, new_cov = step
+
+        # Predict nav action (logits in fp32 under autocast, for the -inf masking)
+        nav_logit = self.nav_predictor(h_tilde).float()
         nav_logit.data.masked_fill_(nav_logit_mask, -float('inf'))
         nav_softmax = F.softmax(nav_logit, dim=1)
         if not self.backprop_softmax:
@@ -222,20 +355,43 @@ class AskAttnDecoderLSTM(nn.Module):
 
         ask_output, _ = self.ask_predictor_lstm(concat_ask_predictor_input.unsqueeze(0), h)
         ask_output = ask_output.squeeze(0)
-        ask_logit = self.ask_predictor(ask_output)
+        ask_logit = self.ask_predictor(ask_output).float()
         ask_logit.data.masked_fill_(ask_logit_mask, -float('inf'))
         ask_softmax = F.softmax(ask_logit, dim=1)
 
-        return new_h, alpha, nav_logit, nav_softmax, ask_softmax, new_cov
-
-    def forward_nav(self, nav_action, ask_action, feature, h, ctx, ctx_mask,
-                    nav_logit_mask, budget=None, cov=None):
-
-        h_tilde, alpha, output_drop, new_h, new_cov = self._lstm_and_attend(
-            nav_action, ask_action, feature, h, ctx, ctx_mask, budget=budget, cov=cov)
-
-        # Predict nav action.
-        nav_logit = self.nav_predictor(h_tilde)
+        return new_h, alpha, nav_logit, nav_softmax, ask_softmax, new_cov, step
+
+    def forward_nav_rows(self, step, rows, nav_action, ask_action, feature, h, ctx,
+                         ctx_mask, nav_logit_mask, budget=None, cov=None):
+        ''' forward_nav that reuses the `step` of forward_cached with the same
+        nav_action, feature, h and cov, recomputing only `rows` (a list of batch
+        indices whose ask_action or context changed since). '''
+
+        h_tilde, alpha, _, new_h, new_cov = step
+        width = ctx.size(1)
+        if alpha.size(1) < width:
+            # The context was widened for longer instructions; the new
+            # positions are masked for the rows that are not recomputed
+            alpha = F.pad(alpha, (0, width - alpha.size(1)))
+            if new_cov is not None:
+                new_cov = F.pad(new_cov, (0, 0, 0, width - new_cov.size(1)))
+
+        if rows:
+            index = torch.tensor(rows, dtype=torch.long, device=nav_action.device)
+            rows_h = None if h is None else tuple(x.index_select(1, index) for x in h)
+            rows_cov = None if cov is None else cov.index_select(0, index)
+            rows_h_tilde, rows_alpha, _, rows_new_h, rows_new_cov = self._lstm_and_attend(
+                nav_action.index_select(0, index), ask_action.index_select(0, index),
+                feature.index_select(0, index), rows_h, ctx.index_select(0, index),
+                ctx_mask.index_select(0, index), cov=rows_cov)
+            h_tilde = h_tilde.index_copy(0, index, rows_h_tilde)
+            alpha = alpha.index_copy(0, index, rows_alpha)
+            new_h = tuple(x.index_copy(1, index, y) for x, y in zip(new_h, rows_new_h))
+            if new_cov is not None:
+                new_cov = new_cov.index_copy(0, index, rows_new_cov)
+
+        # Predict nav action (logits in fp32 under autocast, for the -inf masking)
+        nav_logit = self.nav_predictor(h_tilde).float()
         nav_logit.data.masked_fill_(nav_logit_mask, -float('inf'))
         nav_softmax = F.softmax(nav_logit, dim=1)
 
@@ -273,3 +429,25 @@ class AttentionSeq2SeqModel(nn.Module):
 
     def decode_nav(self, *args, **kwargs):
         return self.decoder.forward_nav(*args, **kwargs)
+
+    def decode_cached(self, *args, **kwargs):
+        return self.decoder.forward_cached(*args, **kwargs)
+
+    def decode_nav_rows(self, *args, **kwargs):
+        return self.decoder.forward_nav_rows(*args, **kwargs)
+
+
+def quantize_dynamic(model):
+    ''' Copy of the model whose nn.LSTM and nn.Linear layers have int8 weights
+    (activations are quantized on the fly), for evaluation on CPU. '''
+    decoder = model.decoder
+    if decoder.compile_decoder != 'none':
+        # Compiled steps read the float weights of the layers
+        print('Quantized layers are not supported by -compile_decoder %s, '
+              'falling back to the eager decode step' % decoder.compile_decoder)
+        decoder.compile_decoder = 'none'
+        decoder.compiled_step = None
+        decoder.attention_layer.script = False
+
+    quantization = torch.ao.quantization if hasattr(torch, 'ao') else torch.quantization
+    return quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
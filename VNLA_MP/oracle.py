@@ -9,23 +9,85 @@ import scipy.stats
 import random
 import sys
 import copy
+import itertools
 import numpy as np
+from collections import OrderedDict
 
 import torch
 
 import utils
-sys.path.append('../../build')
-import MatterSim
+from path_cache import load_shortest_paths, load_scans
+from simulator import load_nav_tables, load_batched_nav_tables, view_heading, \
+    view_elevation, discretize_view
+
+class ShortestPathTables(object):
+    ''' Shortest paths of all scans of a BatchedNavTables, flattened into one
+    distance and one next-hop array addressed by global viewpoint indices, so
+    that the next actions of a whole batch can be found with NumPy indexing.
+    distance(g, h) = distances[row_offset[g] + column[h]]. '''
+
+    def __init__(self, nav_tables, paths):
+        self.nav_tables = nav_tables
+        self.n_scans = 0
+        self.distances = np.zeros(0, dtype=np.float32)
+        self.next_hops = np.zeros(0, dtype=np.int64)
+        self.row_offset = np.zeros(0, dtype=np.int64)
+        self.column = np.zeros(0, dtype=np.int64)
+        self.update(paths)
+
+    def update(self, paths):
+        ''' Append the scans added to the nav tables since the last update. '''
+        tables = self.nav_tables
+        if self.n_scans == len(tables.scans):
+            return
+        distances = [self.distances]
+        next_hops = [self.next_hops]
+        row_offset = [self.row_offset]
+        column = [self.column]
+        offset = len(self.distances)
+        for s in range(self.n_scans, len(tables.scans)):
+            shortest_paths = paths[tables.scans[s]]
+            n = len(shortest_paths.viewpoint_ids)
+            # Shortest path index <-> global viewpoint index
+            to_global = np.array([tables.vp_offset[s] + tables.scan_tables[s].index[viewpoint]
+                for viewpoint in shortest_paths.viewpoint_ids], dtype=np.int64)
+            to_local = np.array([shortest_paths.index.get(viewpoint, -1)
+                for viewpoint in tables.scan_tables[s].viewpoint_ids], dtype=np.int64)
+            hops = np.asarray(shortest_paths.next_hops, dtype=np.int64)
+            distances.append(np.asarray(shortest_paths.distances).ravel())
+            next_hops.append(np.where(hops >= 0, to_global[hops], -1).ravel())
+            row_offset.append(np.where(to_local >= 0, offset + to_local * n, -1))
+            column.append(to_local)
+            offset += n * n
+        self.distances = np.concatenate(distances)
+        self.next_hops = np.concatenate(next_hops)
+        self.row_offset = np.concatenate(row_offset)
+        self.column = np.concatenate(column)
+        self.n_scans = len(tables.scans)
+
+    def nearest(self, viewpoint, goals):
+        ''' Distance to and global index of the nearest goal of each agent.
+        `goals` is a (batch_size, n_goals) array padded with -1. '''
+        d = self.distances[self.row_offset[viewpoint][:, None] + self.column[goals]]
+        d[goals < 0] = np.inf
+        k = d.argmin(axis=1)
+        rows = np.arange(len(viewpoint))
+        return d[rows, k], goals[rows, k]
+
+    def next_point(self, viewpoint, goal):
+        return self.next_hops[self.row_offset[viewpoint] + self.column[goal]]
+
 
 class ShortestPathOracle(object):
     ''' Shortest navigation teacher '''
 
     def __init__(self, agent_nav_actions, env_nav_actions=None):
         self.scans = set()
-        self.graph = {}
         self.paths = {}
-        self.distances = {}
         self.agent_nav_actions = agent_nav_actions
+        # (scan, viewpoint, viewIndex, goals) on the teacher's trajectories -> env action
+        self.trajectory_index = {}
+        self.indexed_items = set()
 
         if env_nav_actions is not None:
             self.env_nav_actions = env_nav_actions
@@ -34,33 +96,18 @@ class ShortestPathOracle(object):
         new_scans = set.difference(scans, self.scans)
         if new_scans:
             print('Loading navigation graphs for %d scans' % len(new_scans))
-            for scan in new_scans:
-                graph, paths, distances = self._compute_shortest_paths(scan, path=path)
-                self.graph[scan] = graph
-                self.paths[scan] = paths
-                self.distances[scan] = distances
+            self.paths.update(load_scans(new_scans, path=path))
             self.scans.update(new_scans)
 
     def _compute_shortest_paths(self, scan, path=None):
         ''' Load connectivity graph for each scan, useful for reasoning about shortest paths '''
-        graph = utils.load_nav_graphs(scan, path=path)
-        paths = dict(nx.all_pairs_dijkstra_path(graph))
-        distances = dict(nx.all_pairs_dijkstra_path_length(graph))
-        return graph, paths, distances
+        return load_shortest_paths(scan, path=path)
 
     def _find_nearest_point(self, scan, start_point, end_points):
-        best_d = 1e9
-        best_point = None
-
-        for end_point in end_points:
-            d = self.distances[scan][start_point][end_point]
-            if d < best_d:
-                best_d = d
-                best_point = end_point
-        return best_d, best_point
+        return self.paths[scan].nearest(start_point, end_points)
 
     def _find_nearest_point_on_a_path(self, scan, current_point, start_point, goal_point):
-        path = self.paths[scan][start_point][goal_point]
+        path = self.paths[scan].path(start_point, goal_point)
         return self._find_nearest_point(scan, current_point, path)
 
     def _shortest_path_action(self, ob):
@@ -76,8 +123,7 @@ class ShortestPathOracle(object):
         if start_point == goal_point:
             return (0, 0, 0)
 
-        path = self.paths[scan][start_point][goal_point]
-        next_point = path[1]
+        next_point = self.paths[scan].next_point(start_point, goal_point)
 
         # Can we see the next viewpoint?
         for i, loc in enumerate(ob['navigableLocations']):
@@ -101,7 +147,7 @@ class ShortestPathOracle(object):
             return (0, 0,-1) # Look down
 
         # Otherwise decide which way to turn
-        target_rel = self.graph[ob['scan']].nodes[next_point]['position'] - ob['point']
+        target_rel = self.paths[ob['scan']].position(next_point) - ob['point']
         target_heading = math.pi / 2.0 - math.atan2(target_rel[1], target_rel[0])
         if target_heading < 0:
             target_heading += 2.0 * math.pi
@@ -112,6 +158,134 @@ class ShortestPathOracle(object):
 
         return (0, 1, 0) # Turn right
 
+    def _trajectory_key(self, ob):
+        return (ob['scan'], ob['viewpoint'], ob['viewIndex'], tuple(ob['goal_viewpoints']))
+
+    def _indexed_action(self, ob):
+        ''' _shortest_path_action, looked up in the trajectory index when the
+        agent is on a teacher trajectory. '''
+        action = self.trajectory_index.get(self._trajectory_key(ob))
+        if action is None:
+            return self._shortest_path_action(ob)
+        return action
+
+    def add_trajectories(self, data, max_steps=100):
+        ''' Index the teacher's action at every state of the teacher
+        trajectories of `data` (the `trajectories` of each item), replayed from
+        the start of each episode through the nav graph tables. '''
+        self.add_scans(set(item['scan'] for item in data))
+        for item in data:
+            item_key = (item['scan'], item['instr_id'])
+            if item_key in self.indexed_items:
+                continue
+            self.indexed_items.add(item_key)
+            tables = load_nav_tables(item['scan'])
+            if 'first_goal_viewpoints' in item: # multi-priority task
+                goal_phases = [item['first_goal_viewpoints'], item['second_goal_viewpoints']]
+            else:
+                goal_phases = [item['goal_viewpoints']]
+            ob = { 'scan': item['scan'], 'goal_viewpoints': goal_phases.pop(0) }
+            goals = tuple(ob['goal_viewpoints'])
+            i = tables.index[item['start_viewpoint']]
+            view_index = discretize_view(item['initial_heading'], 0)
+            for _ in range(max_steps):
+                ob['viewpoint'] = tables.viewpoint_ids[i]
+                ob['viewIndex'] = view_index
+                ob['heading'] = view_heading(view_index)
+                ob['navigableLocations'] = tables.navigable_locations(i, view_index)
+                ob['point'] = tables.points[i]
+                action = self._shortest_path_action(ob)
+                self.trajectory_index[(item['scan'], ob['viewpoint'], view_index, goals)] = action
+                if action == (0, 0, 0):
+                    if not goal_phases:
+                        break
+                    ob['goal_viewpoints'] = goal_phases.pop(0)
+                    goals = tuple(ob['goal_viewpoints'])
+                i, view_index = tables.transition(i, view_index, action)
+
+    def _batched_tables(self, nav_tables):
+        if not hasattr(self, 'path_tables') or self.path_tables.nav_tables is not nav_tables:
+            self.path_tables = ShortestPathTables(nav_tables, self.paths)
+        self.add_scans(set(nav_tables.scans))
+        self.path_tables.update(self.paths)
+        return self.path_tables
+
+    def next_actions(self, nav_tables, viewpoint, view_index, heading, goals):
+        ''' Vectorized _shortest_path_action for a batch of agents given as
+        arrays of global viewpoint indices (into `nav_tables`), view indices,
+        headings and -1 padded goal sets. Returns a (batch_size, 3) array of
+        env actions. '''
+
+        path_tables = self._batched_tables(nav_tables)
+        rows = np.arange(len(viewpoint))
+        _, goal = path_tables.nearest(viewpoint, goals)
+        next_point = path_tables.next_point(viewpoint, goal)
+
+        # Can we see the next viewpoint?
+        match = nav_tables.nav_index[viewpoint, view_index] == next_point[:, None]
+        visible = match.any(axis=1)
+        loc = match.argmax(axis=1)
+        rel_heading = nav_tables.rel_heading[viewpoint, view_index, loc]
+        rel_elevation = nav_tables.rel_elevation[viewpoint, view_index, loc]
+        elevation_step = view_index // 12
+
+        # Otherwise decide which way to turn
+        target_rel = nav_tables.points[next_point] - nav_tables.points[viewpoint]
+        target_heading = np.pi / 2.0 - np.arctan2(target_rel[:, 1], target_rel[:, 0])
+        target_heading = np.where(target_heading < 0, target_heading + 2.0 * np.pi,
+            target_heading)
+        turn_left = ((heading > target_heading) & (heading - target_heading < np.pi)) | \
+            ((target_heading > heading) & (target_heading - heading > np.pi))
+
+        actions = np.zeros((len(viewpoint), 3), dtype=np.int64)
+        # Conditions in reverse priority order, later ones overwrite
+        actions[:, 1] = np.where(turn_left, -1, 1)
+        actions[elevation_step == 2] = (0, 0, -1)
+        actions[elevation_step == 0] = (0, 0, 1)
+        move = visible.copy()
+        for mask, action in [
+                ((rel_elevation < -math.pi/6.0) & (elevation_step > 0), (0, 0,-1)),
+                ((rel_elevation > math.pi/6.0) & (elevation_step < 2), (0, 0, 1)),
+                (rel_heading < -math.pi/6.0, (0,-1, 0)),
+                (rel_heading > math.pi/6.0, (0, 1, 0))]:
+            mask = mask & visible
+            actions[mask] = action
+            move &= ~mask
+        actions[move] = 0
+        actions[move, 0] = loc[move]
+        # Stop if a goal is reached
+        actions[goal == viewpoint] = 0
+        return actions
+
+    def map_env_actions_to_agent_actions(self, actions, ended, ignore_end):
+        ''' Vectorized _map_env_action_to_agent_action; `ignore_end` marks
+        multi-priority agents that have not reached their first goal. '''
+        index = self.agent_nav_actions.index
+        return np.select(
+            [actions[:, 1] > 0, actions[:, 1] < 0, actions[:, 2] > 0, actions[:, 2] < 0,
+             actions[:, 0] > 0, ended | ignore_end],
+            [index('right'), index('left'), index('up'), index('down'),
+             index('forward'), index('<ignore>')],
+            default=index('<end>'))
+
+    def _batched_call(self, obs):
+        state = obs.state
+        goals = obs.goal_index.copy()
+        ended = np.zeros(len(obs), dtype=bool)
+        ignore_end = np.zeros(len(obs), dtype=bool)
+        for i, ob in enumerate(obs):
+            # Goals changed on the dict (e.g. by the advisor)
+            if ob['goal_viewpoints'] is not obs.goal_viewpoints[i]:
+                goals[i] = -1
+                goals[i, :len(ob['goal_viewpoints'])] = [state.env.tables.global_index(
+                    ob['scan'], goal) for goal in ob['goal_viewpoints']]
+            ended[i] = ob['ended']
+            ignore_end[i] = ('reached_first_goal' in ob) and (not ob['reached_first_goal'])
+        actions = self.next_actions(state.env.tables, state.viewpoint, state.view_index,
+            state.heading(), goals)
+        self.actions = list(map(tuple, actions.tolist()))
+        return self.map_env_actions_to_agent_actions(actions, ended, ignore_end).tolist()
+
     def _map_env_action_to_agent_action(self, action, ob):
         ix, heading_chg, elevation_chg = action
         if heading_chg > 0:
@@ -148,14 +322,12 @@ class ShortestPathOracle(object):
         # Find nearest goal view point
         _, goal_point = self._find_nearest_point(scan, start_point, ob['goal_viewpoints'])
 
-        optimal_path = self.paths[scan][start_point][goal_point]
-
         # If it is at the goal, take action 1.
         # The dataset guarantees that the goal is always reachable.
-        if len(optimal_path) < 2:
+        if start_point == goal_point:
             return (1, 0, 0)
 
-        next_optimal_point = optimal_path[1]
+        next_optimal_point = self.paths[scan].next_point(start_point, goal_point)
 
         # If the next optimal viewpoint is within 30 degrees of the center of
         # the view, go to it.
@@ -172,7 +344,9 @@ class ShortestPathOracle(object):
         return (1, 0, 0)
 
     def __call__(self, obs):
-        self.actions = list(map(self._shortest_path_action, obs))
+        if hasattr(obs, 'goal_index'):
+            return self._batched_call(obs)
+        self.actions = list(map(self._indexed_action, obs))
         return list(map(self._map_env_action_to_agent_action, self.actions, obs))
 
 
@@ -182,6 +356,9 @@ class AskOracle(object):
     DONT_ASK = 0
     ASK = 1
 
+    # Reason codes of batch_call, in the order the rules are checked
+    REASONS = ['pass', 'exceed', 'arrive', 'deviate', 'uncertain', 'unmoved', 'why_not']
+
     def __init__(self, hparams, agent_ask_actions):
         self.deviate_threshold = hparams.deviate_threshold
         self.uncertain_threshold = hparams.uncertain_threshold
@@ -191,6 +368,17 @@ class AskOracle(object):
         self.rule_a_e = hasattr(hparams, 'rule_a_e') and hparams.rule_a_e
         self.rule_b_d = hasattr(hparams, 'rule_b_d') and hparams.rule_b_d
 
+    def _distance_to_optimal_path(self, ob, nav_oracle, goal_point):
+        ''' Distance from the current point to the shortest path from the
+        start point to `goal_point`, from the table precomputed at reset. '''
+        scan = ob['scan']
+        if 'path_distances' in ob and goal_point in ob['path_distances']:
+            return float(ob['path_distances'][goal_point][
+                nav_oracle.paths[scan].index[ob['viewpoint']]])
+        d, _ = nav_oracle._find_nearest_point_on_a_path(scan, ob['viewpoint'],
+            ob['init_viewpoint'], goal_point)
+        return d
+
     def _should_ask_rule_a_e(self, ob, nav_oracle=None):
 
         if ob['queries_unused'] <= 0:
@@ -205,8 +393,7 @@ class AskOracle(object):
            agent_decision == nav_oracle.agent_nav_actions.index('forward'):
             return self.ASK, 'arrive'
 
-        start_point = ob['init_viewpoint']
-        d, _ = nav_oracle._find_nearest_point_on_a_path(scan, current_point, start_point, goal_point)
+        d = self._distance_to_optimal_path(ob, nav_oracle, goal_point)
         if d > self.deviate_threshold:
             return self.ASK, 'deviate'
 
@@ -257,11 +444,9 @@ class AskOracle(object):
            agent_decision == nav_oracle.agent_nav_actions.index('forward'):
             return self.ASK, 'arrive'
 
-        start_point = ob['init_viewpoint']
-        # Find closest point to the current point on the path from start point
-        # to goal point
-        d, _ = nav_oracle._find_nearest_point_on_a_path(scan, current_point,
-            start_point, goal_point)
+        # Distance from the current point to the closest point on the path
+        # from start point to goal point
+        d = self._distance_to_optimal_path(ob, nav_oracle, goal_point)
         # Rule (a): ask if the agent deviates too far from the optimal path
         if d > self.deviate_threshold:
             return self.ASK, 'deviate'
@@ -292,6 +477,64 @@ class AskOracle(object):
             return self.agent_ask_actions.index('dont_ask')
         return self.agent_ask_actions.index('ask')
 
+    def _goal_progress(self, obs, nav_oracle):
+        ''' Whether each agent is at its nearest goal, and its distance to the
+        optimal path to that goal. '''
+        at_goal = np.zeros(len(obs), dtype=bool)
+        deviation = np.zeros(len(obs))
+        for i, ob in enumerate(obs):
+            _, goal_point = nav_oracle._find_nearest_point(ob['scan'], ob['viewpoint'],
+                ob['goal_viewpoints'])
+            at_goal[i] = ob['viewpoint'] == goal_point
+            deviation[i] = self._distance_to_optimal_path(ob, nav_oracle, goal_point)
+        return at_goal, deviation
+
+    def batch_call(self, obs, nav_oracle, nav_softmax, queries_unused, traj_len,
+                   time_step, unmoved, ended):
+        ''' Tensorized __call__ for the whole batch. The entropy gap is computed
+        on `nav_softmax`; `unmoved` counts the trailing steps each agent has
+        stayed at the same viewpoint. Returns ask targets and reason codes
+        (indices into REASONS) as tensors on the device of `nav_softmax`. '''
+
+        device = nav_softmax.device
+        queries_unused = torch.as_tensor(queries_unused, dtype=torch.long, device=device)
+        ended = torch.as_tensor(ended, dtype=torch.bool, device=device)
+        use_rule_a_e = self.rule_a_e or not self.rule_b_d
+        use_rule_b_d = not self.rule_a_e
+
+        # Rules in the order _should_ask checks them
+        rules = [('exceed', queries_unused <= 0)]
+        if use_rule_a_e:
+            at_goal, deviation = self._goal_progress(obs, nav_oracle)
+            agent_decision = nav_softmax.argmax(dim=1)
+            rules.append(('arrive', torch.as_tensor(at_goal, device=device) &
+                (agent_decision == nav_oracle.agent_nav_actions.index('forward'))))
+            rules.append(('deviate',
+                torch.as_tensor(deviation > self.deviate_threshold, device=device)))
+        if use_rule_b_d:
+            agent_dist = nav_softmax.detach().double()
+            entropy = -(agent_dist * agent_dist.clamp(min=1e-300).log()).sum(dim=1)
+            entropy_gap = math.log(agent_dist.size(1)) - entropy
+            rules.append(('uncertain', entropy_gap < self.uncertain_threshold - 1e-9))
+            rules.append(('unmoved', torch.as_tensor(unmoved, device=device) >=
+                self.unmoved_threshold))
+            rules.append(('why_not', queries_unused >=
+                torch.as_tensor(traj_len, dtype=torch.long, device=device) - time_step))
+
+        # Apply in reverse so that the first matching rule wins
+        reasons = torch.zeros(len(obs), dtype=torch.long, device=device)
+        for reason, mask in reversed(rules):
+            reasons = torch.where(mask, torch.full_like(reasons, self.REASONS.index(reason)),
+                reasons)
+
+        should_ask = reasons > self.REASONS.index('exceed')
+        targets = torch.where(should_ask,
+            torch.full_like(reasons, self.agent_ask_actions.index('ask')),
+            torch.full_like(reasons, self.agent_ask_actions.index('dont_ask')))
+        targets = torch.where(ended, torch.full_like(reasons,
+            self.agent_ask_actions.index('<ignore>')), targets)
+        return targets, reasons
+
     def __call__(self, obs, nav_oracle):
         should_ask_fn = functools.partial(self._should_ask, nav_oracle=nav_oracle)
         actions, reasons = zip(*list(map(should_ask_fn, obs)))
@@ -300,24 +543,32 @@ class AskOracle(object):
 
 
 class MultistepShortestPathOracle(ShortestPathOracle):
+    ''' Rolls the shortest path teacher out for `n_steps` steps. The rollout
+    does not step a simulator: the next state after each action is looked up
+    in the nav graph tables of the discretized 12x3 view grid. '''
 
     def __init__(self, n_steps, agent_nav_actions, env_nav_actions):
         super(MultistepShortestPathOracle, self).__init__(agent_nav_actions)
-        self.sim = MatterSim.Simulator()
-        self.sim.setRenderingEnabled(False)
-        self.sim.setDiscretizedViewingAngles(True)
-        self.sim.setCameraResolution(640, 480)
-        self.sim.setCameraVFOV(math.radians(60))
-        self.sim.setNavGraphPath(
-            os.path.join(os.getenv('PT_DATA_DIR', '../../../data'), 'connectivity'))
-        self.sim.init()
         self.n_steps = n_steps
         self.env_nav_actions = env_nav_actions
 
+    def _state(self, tables, i, view_index):
+        ''' Observation fields of viewpoint `i` of `tables` seen from `view_index`. '''
+        return {
+            'viewpoint': tables.viewpoint_ids[i],
+            'viewIndex': view_index,
+            'heading'  : view_heading(view_index),
+            'elevation': view_elevation(view_index),
+            'navigableLocations': tables.navigable_locations(i, view_index),
+            'point'    : tables.points[i]
+        }
+
     # NOTE: main part to modify for multi-priority goals
     def _shortest_path_actions(self, ob):
         actions = []
-        self.sim.newEpisode(ob['scan'], ob['viewpoint'], ob['heading'], ob['elevation'])
+        tables = load_nav_tables(ob['scan'])
+        i = tables.index[ob['viewpoint']]
+        view_index = ob['viewIndex']
 
         assert not ob['ended']
 
@@ -330,24 +581,18 @@ class MultistepShortestPathOracle(ShortestPathOracle):
             agent_action = self._map_env_action_to_agent_action(action, ob)
             actions.append(agent_action)
             # Take action
-            self.sim.makeAction(*action)
+            i, view_index = tables.transition(i, view_index, action)
 
             if not is_multi_prioirity_task: # For original task
                 if action == (0, 0, 0):
                     break
 
-                state = self.sim.getState()
-                ob = {
-                        'viewpoint': state.location.viewpointId,
-                        'viewIndex': state.viewIndex,
-                        'heading'  : state.heading,
-                        'elevation': state.elevation,
-                        'navigableLocations': state.navigableLocations,
-                        'point'    : state.location.point,
-                        'ended'    : ob['ended'] or action == (0, 0, 0),
-                        'goal_viewpoints': ob['goal_viewpoints'],
-                        'scan'     : ob['scan']
-                    }
+                ended = ob['ended'] or action == (0, 0, 0)
+                goal_viewpoints = ob['goal_viewpoints']
+                ob = self._state(tables, i, view_index)
+                ob['ended'] = ended
+                ob['goal_viewpoints'] = goal_viewpoints
+                ob['scan'] = tables.scan
                 continue
 
             reached_first_goal = ob['reached_first_goal']
@@ -357,21 +602,79 @@ class MultistepShortestPathOracle(ShortestPathOracle):
             elif action == (0, 0, 0) and ob['reached_first_goal']:
                 break
 
-            state = self.sim.getState()
-
-            ob['viewpoint'] = state.location.viewpointId
-            ob['viewIndex'] = state.viewIndex
-            ob['heading'] = state.heading
-            ob['elevation'] = state.elevation
-            ob['navigableLocations'] = state.navigableLocations
-            ob['point'] = state.location.point
+            ob.update(self._state(tables, i, view_index))
             ob['ended'] = ob['ended'] or (action == (0, 0, 0) and reached_first_goal) # Problem was here!
 
         return actions
 
+    def batch_shortest_path_actions(self, obs):
+        ''' _shortest_path_actions for several observations, rolled out
+        together with vectorized lookups in the batched nav tables. '''
+        nav_tables = load_batched_nav_tables()
+        nav_tables.add_scans(set(ob['scan'] for ob in obs))
+        for ob in obs:
+            assert not ob['ended']
+
+        def goal_index(goal_sets):
+            goals = -np.ones((len(obs), max(1, max(map(len, goal_sets)))), dtype=np.int64)
+            for k, (ob, goal_set) in enumerate(zip(obs, goal_sets)):
+                goals[k, :len(goal_set)] = [nav_tables.global_index(ob['scan'], goal)
+                    for goal in goal_set]
+            return goals
+
+        viewpoint = np.array([nav_tables.global_index(ob['scan'], ob['viewpoint'])
+            for ob in obs], dtype=np.int64)
+        view_index = np.array([ob['viewIndex'] for ob in obs], dtype=np.int64)
+        goals = goal_index([ob['goal_viewpoints'] for ob in obs])
+        second_goals = goal_index([ob.get('second_goal_viewpoints', []) for ob in obs])
+        width = max(goals.shape[1], second_goals.shape[1])
+        goals = np.pad(goals, ((0, 0), (0, width - goals.shape[1])),
+            'constant', constant_values=-1)
+        second_goals = np.pad(second_goals, ((0, 0), (0, width - second_goals.shape[1])),
+            'constant', constant_values=-1)
+        multi_priority = np.array(['reached_first_goal' in ob for ob in obs], dtype=bool)
+        reached = np.array([ob.get('reached_first_goal', False) for ob in obs], dtype=bool)
+        switched = np.zeros(len(obs), dtype=bool)
+        ended = np.zeros(len(obs), dtype=bool)
+
+        actions = [[] for _ in obs]
+        rows = np.arange(len(obs))
+        for _ in range(self.n_steps):
+            if len(rows) == 0:
+                break
+            env_actions = self.next_actions(nav_tables, viewpoint[rows], view_index[rows],
+                view_heading(view_index[rows]), goals[rows])
+            agent_actions = self.map_env_actions_to_agent_actions(env_actions, ended[rows],
+                multi_priority[rows] & ~reached[rows])
+            for k, agent_action in zip(rows.tolist(), agent_actions.tolist()):
+                actions[k].append(agent_action)
+            viewpoint[rows], view_index[rows] = nav_tables.transition(
+                viewpoint[rows], view_index[rows], env_actions)
+
+            stop = (env_actions == 0).all(axis=1)
+            switch = rows[stop & multi_priority[rows] & ~reached[rows]]
+            reached[switch] = True
+            switched[switch] = True
+            goals[switch] = second_goals[switch]
+            rows = rows[~stop | (multi_priority[rows] & np.isin(rows, switch))]
+
+        # Multi-priority observations end up in the rolled out state
+        for k, ob in enumerate(obs):
+            if multi_priority[k]:
+                s = nav_tables.viewpoint_scan[viewpoint[k]]
+                ob.update(self._state(nav_tables.scan_tables[s],
+                    viewpoint[k] - nav_tables.vp_offset[s], int(view_index[k])))
+                ob['reached_first_goal'] = bool(reached[k])
+                if switched[k]:
+                    ob['goal_viewpoints'] = ob['second_goal_viewpoints']
+        return actions
+
     def __call__(self, ob):
         return self._shortest_path_actions(ob)
 
+    def batch_call(self, obs):
+        return self.batch_shortest_path_actions(obs)
+
 
 class NextOptimalOracle(object):
 
@@ -392,9 +695,15 @@ class NextOptimalOracle(object):
     def add_scans(self, scans):
         self.nav_oracle.add_scans(scans)
 
+    def add_trajectories(self, data):
+        self.nav_oracle.add_trajectories(data)
+
     def next_ask(self, obs):
         return self.ask_oracle(obs, self.nav_oracle)
 
+    def next_ask_batch(self, obs, *args):
+        return self.ask_oracle.batch_call(obs, self.nav_oracle, *args)
+
     def next_nav(self, obs):
         return self.nav_oracle(obs)
 
@@ -404,7 +713,13 @@ class NextOptimalOracle(object):
 
 class StepByStepSubgoalOracle(object):
 
-    def __init__(self, n_steps, agent_nav_actions, env_nav_actions, mode=None):
+    # Fields of a multi-priority observation that the nav oracle overwrites
+    # with its simulated end state; replayed on cache hits.
+    MUTATED_KEYS = ['viewpoint', 'viewIndex', 'heading', 'elevation',
+                    'navigableLocations', 'point', 'ended', 'reached_first_goal']
+
+    def __init__(self, n_steps, agent_nav_actions, env_nav_actions, mode=None,
+                 cache_size=100000):
         self.type = 'step_by_step'
         self.nav_oracle = make_oracle('direct', n_steps, agent_nav_actions, env_nav_actions)
         self.agent_nav_actions = agent_nav_actions
@@ -415,6 +730,12 @@ class StepByStepSubgoalOracle(object):
         else:
             sys.exit('unknown step by step mode!')
 
+        # LRU cache of subgoals, keyed on the state they depend on
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def add_scans(self, scans):
         self.nav_oracle.add_scans(scans)
 
@@ -466,11 +787,151 @@ class StepByStepSubgoalOracle(object):
             instruction.append(self._make_action_name(a))
         return ' , '.join(instruction)
 
-    def __call__(self, ob):
+    # Largest number of action sequences tabulated up front by subgoal_words
+    SUBGOAL_TABLE_MAX_SIZE = 100000
+
+    def subgoal_words(self, action_seq, tokenizer):
+        ''' Token ids of the verbal subgoal of `action_seq`, followed by '.',
+        ready to be prepended to a tokenized instruction. Looked up in a table
+        from action tuples, built once per tokenizer. '''
+        if getattr(self, 'subgoal_tokenizer', None) is not tokenizer:
+            self._make_subgoal_table(tokenizer)
+        action_seq = tuple(action_seq)
+        if action_seq not in self.subgoal_table:
+            self.subgoal_table[action_seq] = tokenizer.encode_words(
+                self._map_actions_to_instruction(action_seq), cache=False) + \
+                tokenizer.encode_words('.')
+        return self.subgoal_table[action_seq]
+
+    def _make_subgoal_table(self, tokenizer):
+        ''' Tabulate every sequence of up to n_steps actions the nav oracle
+        can suggest, unless there are too many. '''
+        self.subgoal_tokenizer = tokenizer
+        self.subgoal_table = {}
+        actions = [self.agent_nav_actions.index(a) for a in
+            ['left', 'right', 'up', 'down', 'forward', '<end>', '<ignore>']]
+        n_steps = self.nav_oracle.n_steps
+        if sum(len(actions) ** n for n in range(1, n_steps + 1)) > \
+                self.SUBGOAL_TABLE_MAX_SIZE:
+            return
+        for n in range(1, n_steps + 1):
+            for action_seq in itertools.product(actions, repeat=n):
+                self.subgoal_words(action_seq, tokenizer)
+
+    def _cache_key(self, ob):
+        key = (ob['scan'], ob['viewpoint'], ob['viewIndex'], tuple(ob['goal_viewpoints']))
+        if 'reached_first_goal' in ob: # multi-priority task
+            key += (ob['reached_first_goal'], tuple(ob['second_goal_viewpoints']))
+        return key
+
+    def _compute_subgoal(self, ob):
         action_seq = self.nav_oracle(ob)
         verbal_instruction = self._map_actions_to_instruction(action_seq)
         return action_seq, verbal_instruction
 
+    def __call__(self, ob):
+        if self.cache_size <= 0:
+            return self._compute_subgoal(ob)
+
+        key = self._cache_key(ob)
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            action_seq, verbal_instruction, ob_updates = self.cache[key]
+            if ob_updates is not None:
+                to_second_goals = ob_updates.pop('to_second_goals')
+                ob.update(ob_updates)
+                ob_updates['to_second_goals'] = to_second_goals
+                if to_second_goals:
+                    ob['goal_viewpoints'] = ob['second_goal_viewpoints']
+        else:
+            self.cache_misses += 1
+            goal_viewpoints = ob['goal_viewpoints']
+            action_seq, verbal_instruction = self._compute_subgoal(ob)
+            ob_updates = None
+            if 'reached_first_goal' in ob:
+                ob_updates = dict((k, ob[k]) for k in self.MUTATED_KEYS)
+                ob_updates['to_second_goals'] = ob['goal_viewpoints'] is not goal_viewpoints
+            self.cache[key] = (action_seq, verbal_instruction, ob_updates)
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return list(action_seq), verbal_instruction
+
+    def batch_call(self, obs):
+        ''' __call__ for several observations. Cache misses are rolled out
+        together by the nav oracle. '''
+        if self.cache_size <= 0:
+            return [(action_seq, self._map_actions_to_instruction(action_seq))
+                for action_seq in self.nav_oracle.batch_call(obs)]
+
+        results = [None] * len(obs)
+        misses = OrderedDict()
+        repeats = []
+        for i, ob in enumerate(obs):
+            key = self._cache_key(ob)
+            if key in misses:
+                repeats.append(i)
+            elif key in self.cache:
+                results[i] = self(ob)
+            else:
+                misses[key] = i
+        if misses:
+            miss_obs = [obs[i] for i in misses.values()]
+            goal_viewpoints = [ob['goal_viewpoints'] for ob in miss_obs]
+            action_seqs = self.nav_oracle.batch_call(miss_obs)
+            for (key, i), action_seq, goals in zip(misses.items(), action_seqs,
+                    goal_viewpoints):
+                self.cache_misses += 1
+                ob = obs[i]
+                verbal_instruction = self._map_actions_to_instruction(action_seq)
+                ob_updates = None
+                if 'reached_first_goal' in ob:
+                    ob_updates = dict((k, ob[k]) for k in self.MUTATED_KEYS)
+                    ob_updates['to_second_goals'] = ob['goal_viewpoints'] is not goals
+                self.cache[key] = (action_seq, verbal_instruction, ob_updates)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                results[i] = list(action_seq), verbal_instruction
+        # Observations repeating a miss of this batch are now cache hits
+        for i in repeats:
+            results[i] = self(obs[i])
+        return results
+
+    def cache_info(self):
+        return { 'hits': self.cache_hits, 'misses': self.cache_misses,
+                 'size': len(self.cache), 'max_size': self.cache_size }
+
+    def precompute(self, data, max_steps=100):
+        ''' Offline precompute mode: fill the cache with the subgoals of every
+        state on the teacher's path of each episode in `data`. '''
+        nav_oracle = self.nav_oracle
+        nav_oracle.add_scans(set(item['scan'] for item in data))
+        for item in data:
+            tables = load_nav_tables(item['scan'])
+            ob = { 'scan': item['scan'], 'ended': False,
+                   'init_viewpoint': item['start_viewpoint'] }
+            if 'first_goal_viewpoints' in item: # multi-priority task
+                ob['first_goal_viewpoints'] = item['first_goal_viewpoints']
+                ob['second_goal_viewpoints'] = item['second_goal_viewpoints']
+                ob['goal_viewpoints'] = item['first_goal_viewpoints']
+                ob['reached_first_goal'] = False
+            else:
+                ob['goal_viewpoints'] = item['goal_viewpoints']
+            i = tables.index[item['start_viewpoint']]
+            view_index = discretize_view(item['initial_heading'], 0)
+            for _ in range(max_steps):
+                ob.update(nav_oracle._state(tables, i, view_index))
+                # The nav oracle rewrites multi-priority observations
+                self(dict(ob))
+                action = nav_oracle._shortest_path_action(ob)
+                if action == (0, 0, 0):
+                    break
+                i, view_index = tables.transition(i, view_index, action)
+                if 'reached_first_goal' in ob and not ob['reached_first_goal'] and \
+                   tables.viewpoint_ids[i] in ob['first_goal_viewpoints']:
+                    ob['reached_first_goal'] = True
+                    ob['goal_viewpoints'] = ob['second_goal_viewpoints']
+
 
 def make_oracle(oracle_type, *args, **kwargs):
     if oracle_type == 'shortest':
@@ -0,0 +1,127 @@
+import os
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import utils
+
+'''
+On-disk cache of the all-pairs shortest paths of each scan (see
+`utils.ShortestPaths`). The arrays of a scan are written once, under a key
+derived from the hash of its connectivity file, and memory-mapped afterwards,
+so the oracles, the evaluation and the dataset generators skip graph
+construction and Dijkstra on every later start. Editing a connectivity file
+changes its hash, so stale entries are never read.
+
+The cache lives in $PT_PATH_CACHE_DIR, or `shortest_paths/` under the data
+directory by default.
+
+Within a process, every scan is loaded once and the same read-only
+ShortestPaths is handed to all callers (teachers, advisor, evaluators).
+'''
+
+CACHE_VERSION = 1
+ARRAYS = ['distances', 'next_hops', 'positions']
+
+# Process-wide registry: connectivity file -> read-only ShortestPaths
+_registry = {}
+
+
+def connectivity_path(scan, path=None):
+    DATA_DIR = path if path is not None else os.getenv('PT_DATA_DIR', '../../../data')
+    return os.path.join(DATA_DIR, 'connectivity/%s_connectivity.json' % scan)
+
+def default_cache_dir(path=None):
+    DATA_DIR = path if path is not None else os.getenv('PT_DATA_DIR', '../../../data')
+    return os.getenv('PT_PATH_CACHE_DIR', os.path.join(DATA_DIR, 'shortest_paths'))
+
+def cache_key(scan, path=None):
+    with open(connectivity_path(scan, path=path), 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return '%s_v%d_%s' % (scan, CACHE_VERSION, digest[:16])
+
+def _cache_files(cache_dir, key):
+    files = dict((name, os.path.join(cache_dir, '%s.%s.npy' % (key, name)))
+        for name in ARRAYS)
+    files['viewpoint_ids'] = os.path.join(cache_dir, '%s.viewpoints.json' % key)
+    return files
+
+def _write_cache(files, shortest_paths):
+    for name in ARRAYS:
+        tmp_path = files[name] + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, getattr(shortest_paths, name))
+        os.replace(tmp_path, files[name])
+    # Written last: its presence marks a complete entry
+    tmp_path = files['viewpoint_ids'] + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(shortest_paths.viewpoint_ids, f)
+    os.replace(tmp_path, files['viewpoint_ids'])
+
+def _read_cache(files):
+    with open(files['viewpoint_ids']) as f:
+        viewpoint_ids = json.load(f)
+    arrays = [np.load(files[name], mmap_mode='r') for name in ARRAYS]
+    return utils.ShortestPaths(viewpoint_ids, *arrays)
+
+def load_shortest_paths(scan, path=None, cache_dir=None):
+    ''' Read-only ShortestPaths of a scan, shared by all callers in the
+    process. The first call reads it from the cache, or computes and caches it. '''
+
+    registry_key = _registry_key(scan, path=path)
+    if registry_key not in _registry:
+        cache_dir = cache_dir if cache_dir is not None else default_cache_dir(path=path)
+        files = _cache_files(cache_dir, cache_key(scan, path=path))
+        if os.path.exists(files['viewpoint_ids']):
+            shortest_paths = _read_cache(files)
+        else:
+            shortest_paths = _build_and_cache(scan, path, cache_dir)
+        _register(registry_key, shortest_paths)
+    return _registry[registry_key]
+
+def load_scans(scans, path=None, cache_dir=None, workers=None):
+    ''' Load several scans into the registry. Scans missing from the cache are
+    built in parallel over `workers` processes (default: one per core). '''
+
+    cache_dir = cache_dir if cache_dir is not None else default_cache_dir(path=path)
+    missing = [scan for scan in sorted(set(scans))
+        if _registry_key(scan, path=path) not in _registry and not os.path.exists(
+            _cache_files(cache_dir, cache_key(scan, path=path))['viewpoint_ids'])]
+    if len(missing) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_build_and_cache_worker,
+                [(scan, path, cache_dir) for scan in missing])
+            for scan, shortest_paths in zip(missing, results):
+                # None if the worker wrote the cache; it is memory-mapped below
+                if shortest_paths is not None:
+                    _register(_registry_key(scan, path=path), shortest_paths)
+    return dict((scan, load_shortest_paths(scan, path=path, cache_dir=cache_dir))
+        for scan in scans)
+
+def _registry_key(scan, path=None):
+    return os.path.abspath(connectivity_path(scan, path=path))
+
+def _register(registry_key, shortest_paths):
+    for name in ARRAYS:
+        getattr(shortest_paths, name).flags.writeable = False
+    _registry[registry_key] = shortest_paths
+
+def _build_and_cache(scan, path, cache_dir):
+    files = _cache_files(cache_dir, cache_key(scan, path=path))
+    shortest_paths = utils.ShortestPaths.from_graph(utils.load_nav_graphs(scan, path=path))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _write_cache(files, shortest_paths)
+    except (IOError, OSError) as e:
+        print('Could not cache shortest paths of %s in %s: %s' % (scan, cache_dir, e))
+        return shortest_paths
+    return _read_cache(files)
+
+def _build_and_cache_worker(args):
+    scan, path, cache_dir = args
+    shortest_paths = _build_and_cache(scan, path, cache_dir)
+    if isinstance(shortest_paths.distances, np.memmap):
+        return None
+    return shortest_paths
@@ -0,0 +1,40 @@
+import os
+import glob
+import time
+import argparse
+
+from path_cache import load_scans, default_cache_dir
+
+'''
+Fill the shortest path cache (see path_cache.py) for every scan under
+$PT_DATA_DIR/connectivity, one worker process per core, so that the first
+training/evaluation/generation run does not have to.
+
+Usage: python precompute_shortest_paths.py [-scans scanA,scanB] [-workers N] [-cache_dir DIR]
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-scans', type=str,
+        help='comma-separated scans (default: all scans with a connectivity file)')
+    parser.add_argument('-workers', type=int,
+        help='number of worker processes (default: number of cores)')
+    parser.add_argument('-cache_dir', type=str,
+        help='cache directory (default: $PT_PATH_CACHE_DIR or $PT_DATA_DIR/shortest_paths)')
+    args = parser.parse_args()
+
+    if args.scans is not None:
+        scans = args.scans.split(',')
+    else:
+        DATA_DIR = os.getenv('PT_DATA_DIR', '../../../data')
+        scans = sorted(os.path.basename(f)[:-len('_connectivity.json')] for f in
+            glob.glob(os.path.join(DATA_DIR, 'connectivity/*_connectivity.json')))
+
+    start = time.time()
+    load_scans(scans, cache_dir=args.cache_dir, workers=args.workers)
+    print('Cached shortest paths of %d scans in %s (%.1fs)' % (len(scans),
+        args.cache_dir or default_cache_dir(), time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
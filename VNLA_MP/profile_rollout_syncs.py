@@ -0,0 +1,99 @@
+from __future__ import division
+
+import os
+import sys
+import json
+import warnings
+from argparse import Namespace
+from collections import Counter
+
+import torch
+
+from utils import read_vocab, Tokenizer
+from env import VNLABatch
+from model import AttentionSeq2SeqModel
+from ask_agent import AskAgent
+from verbal_ask_agent import VerbalAskAgent
+from flags import make_parser
+
+'''
+Count the synchronizing CUDA operations (host syncs) of training rollouts with
+torch.cuda.set_sync_debug_mode, per decoding step and by source line, so that
+changes to the rollout loop can be checked for new syncs.
+
+Usage: python profile_rollout_syncs.py -config_file configs/verbal_hard.json [-n_rollouts 5]
+'''
+
+
+def main():
+    parser = make_parser()
+    parser.add_argument('-n_rollouts', type=int, default=5,
+        help='number of profiled rollouts')
+    args = parser.parse_args()
+
+    if not torch.cuda.is_available():
+        sys.exit('profile_rollout_syncs.py needs a CUDA device')
+
+    with open(args.config_file) as f:
+        hparams = Namespace(**json.load(f))
+    for flag in vars(args):
+        value = getattr(args, flag)
+        if value is not None:
+            setattr(hparams, flag, value)
+
+    DATA_DIR = os.getenv('PT_DATA_DIR', '../../../data')
+    hparams.data_path = os.path.join(DATA_DIR, hparams.data_dir)
+    hparams.img_features = os.path.join(DATA_DIR, hparams.img_features)
+
+    vocab_paths = [os.path.join(hparams.data_path, 'train_vocab.txt')]
+    if 'verbal' in hparams.advisor:
+        vocab_paths.append(os.path.join(hparams.data_path, hparams.subgoal_vocab))
+    vocab = read_vocab(vocab_paths)
+    tok = Tokenizer(vocab=vocab, encoding_length=hparams.max_input_length)
+
+    device = torch.device('cuda', hparams.device_id)
+    env = VNLABatch(hparams, split='train', tokenizer=tok)
+    model = AttentionSeq2SeqModel(len(vocab), hparams, device).to(device)
+    if 'verbal' in hparams.advisor:
+        agent = VerbalAskAgent(model, hparams, device)
+    else:
+        agent = AskAgent(model, hparams, device)
+
+    agent.is_eval = False
+    agent._setup(env, { 'nav': hparams.nav_feedback, 'ask': hparams.ask_feedback })
+    model.train()
+
+    # Warm up cuDNN and the caching allocators
+    agent.rollout()
+
+    # Count decoding steps
+    n_steps = [0]
+    decode = model.decode
+    def counting_decode(*args, **kwargs):
+        n_steps[0] += 1
+        return decode(*args, **kwargs)
+    model.decode = counting_decode
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        try:
+            for _ in range(hparams.n_rollouts):
+                agent.rollout()
+            torch.cuda.synchronize()
+        finally:
+            torch.cuda.set_sync_debug_mode('default')
+
+    syncs = Counter('%s:%d' % (os.path.basename(w.filename), w.lineno)
+        for w in caught if 'synchroniz' in str(w.message))
+    total = sum(syncs.values())
+    print('%d rollouts, %d decoding steps, %d host syncs (%.2f per step)' % (
+        hparams.n_rollouts, n_steps[0], total, total / max(1, n_steps[0])))
+    print('')
+    print('%-40s %10s %10s' % ('source line', 'syncs', 'per step'))
+    for line, count in syncs.most_common():
+        print('%-40s %10d %10.2f' % (line, count, count / max(1, n_steps[0])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+from __future__ import division
+
+import os
+import sys
+import json
+import math
+import numpy as np
+
+sys.path.append('../../build')
+try:
+    import MatterSim
+except ImportError:
+    MatterSim = None
+
+'''
+Simulator backends. `make_simulator` returns either a MatterSim.Simulator or a
+GraphSimulator, which reproduces the (rendering-free, discretized) MatterSim
+API used by the environment and the oracles from the connectivity graphs alone:
+every (viewpoint, viewIndex) state has its navigable locations precomputed, so
+stepping is a table lookup and no C++ build is required.
+'''
+
+HEADING_COUNT = 12
+ELEVATION_COUNT = 3
+VIEW_COUNT = HEADING_COUNT * ELEVATION_COUNT
+HEADING_INCREMENT = math.pi * 2.0 / HEADING_COUNT
+ELEVATION_INCREMENT = math.pi / 6.0
+
+simulator_backends = ['mattersim', 'graph']
+
+
+def view_heading(view_index):
+    return (view_index % HEADING_COUNT) * HEADING_INCREMENT
+
+def view_elevation(view_index):
+    return (view_index // HEADING_COUNT - 1) * ELEVATION_INCREMENT
+
+def discretize_view(heading, elevation):
+    ''' Snap a heading and elevation to a view index, like MatterSim's newEpisode. '''
+    heading_step = int(round(heading / HEADING_INCREMENT)) % HEADING_COUNT
+    if elevation < -ELEVATION_INCREMENT / 2.0:
+        return heading_step
+    if elevation > ELEVATION_INCREMENT / 2.0:
+        return heading_step + 2 * HEADING_COUNT
+    return heading_step + HEADING_COUNT
+
+def next_view_index(view_index, heading_chg, elevation_chg):
+    ''' View index after a discretized (heading, elevation) action. '''
+    heading_step = view_index % HEADING_COUNT
+    elevation_step = view_index // HEADING_COUNT
+    if heading_chg > 0:
+        heading_step = (heading_step + 1) % HEADING_COUNT
+    elif heading_chg < 0:
+        heading_step = (heading_step - 1) % HEADING_COUNT
+    if elevation_chg > 0 and elevation_step < ELEVATION_COUNT - 1:
+        elevation_step += 1
+    elif elevation_chg < 0 and elevation_step > 0:
+        elevation_step -= 1
+    return heading_step + elevation_step * HEADING_COUNT
+
+
+class Location(object):
+    ''' Mirrors MatterSim.ViewPoint. '''
+
+    __slots__ = ['viewpointId', 'ix', 'point', 'rel_heading', 'rel_elevation',
+                 'rel_distance']
+
+    def __init__(self, viewpointId, ix, point, rel_heading=0., rel_elevation=0.,
+                 rel_distance=0.):
+        self.viewpointId = viewpointId
+        self.ix = ix
+        self.point = point
+        self.rel_heading = rel_heading
+        self.rel_elevation = rel_elevation
+        self.rel_distance = rel_distance
+
+
+class SimState(object):
+    ''' Mirrors MatterSim.SimState (without rendering). '''
+
+    __slots__ = ['scanId', 'step', 'location', 'viewIndex', 'heading', 'elevation',
+                 'navigableLocations']
+
+    def __init__(self, scanId, step, location, viewIndex, heading, elevation,
+                 navigableLocations):
+        self.scanId = scanId
+        self.step = step
+        self.location = location
+        self.viewIndex = viewIndex
+        self.heading = heading
+        self.elevation = elevation
+        self.navigableLocations = navigableLocations
+
+
+class NavTables(object):
+    ''' Navigable locations of every (viewpoint, viewIndex) of one scan.
+
+    Viewpoints are indexed in the order of the included entries of the
+    connectivity file. For state (i, v), entry k < nav_count[i, v] of the
+    tables describes `navigableLocations[k]`: nav_index is the viewpoint
+    index (entry 0 is the current viewpoint), rel_heading / rel_elevation /
+    rel_distance are the values MatterSim reports. Locations are ordered by
+    angular distance from the center of the view, as in MatterSim. '''
+
+    def __init__(self, scan, nav_graph_path, hfov):
+        self.scan = scan
+        with open(os.path.join(nav_graph_path, '%s_connectivity.json' % scan)) as f:
+            data = json.load(f)
+
+        included = [j for j, item in enumerate(data) if item['included']]
+        local_index = { j : i for i, j in enumerate(included) }
+        self.viewpoint_ids = [data[j]['image_id'] for j in included]
+        self.index = { vp : i for i, vp in enumerate(self.viewpoint_ids) }
+        self.points = np.array([[data[j]['pose'][3], data[j]['pose'][7],
+            data[j]['pose'][11]] for j in included], dtype=np.float64)
+        self.points.flags.writeable = False
+
+        n = len(included)
+        neighbors = []
+        for j in included:
+            neighbors.append([local_index[k] for k, conn in enumerate(data[j]['unobstructed'])
+                              if conn and k != j and data[k]['included']])
+
+        cos_half_hfov = math.cos(hfov / 2.0)
+        table = [[None] * VIEW_COUNT for _ in range(n)]
+        for i in range(n):
+            nbrs = np.array(neighbors[i], dtype=np.int64)
+            diff = self.points[nbrs] - self.points[i] if len(nbrs) else np.zeros((0, 3))
+            distance = np.hypot(diff[:, 0], diff[:, 1])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                base_elevation = np.arctan2(diff[:, 2], distance)
+            for v in range(VIEW_COUNT):
+                heading = view_heading(v)
+                elevation = view_elevation(v)
+                camera_x, camera_y = math.sin(heading), math.cos(heading)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    visible = (diff[:, 0] * camera_x + diff[:, 1] * camera_y) / distance \
+                        >= cos_half_hfov
+                rel_heading = np.arctan2(diff[:, 0] * camera_y - camera_x * diff[:, 1],
+                                         diff[:, 0] * camera_x + diff[:, 1] * camera_y)
+                rel_elevation = base_elevation - elevation
+                entries = [(0., i, 0., 0., 0.)]
+                for k in np.nonzero(visible)[0]:
+                    entries.append((math.sqrt(rel_heading[k] ** 2 + rel_elevation[k] ** 2),
+                        nbrs[k], rel_heading[k], rel_elevation[k], distance[k]))
+                entries.sort(key=lambda e: e[0])
+                table[i][v] = entries
+
+        max_count = max(len(entries) for row in table for entries in row) if n else 1
+        self.nav_count = np.zeros((n, VIEW_COUNT), dtype=np.int32)
+        self.nav_index = -np.ones((n, VIEW_COUNT, max_count), dtype=np.int32)
+        self.rel_heading = np.zeros((n, VIEW_COUNT, max_count), dtype=np.float64)
+        self.rel_elevation = np.zeros((n, VIEW_COUNT, max_count), dtype=np.float64)
+        self.rel_distance = np.zeros((n, VIEW_COUNT, max_count), dtype=np.float64)
+        for i in range(n):
+            for v in range(VIEW_COUNT):
+                entries = table[i][v]
+                self.nav_count[i, v] = len(entries)
+                for k, (_, j, h, e, d) in enumerate(entries):
+                    self.nav_index[i, v, k] = j
+                    self.rel_heading[i, v, k] = h
+                    self.rel_elevation[i, v, k] = e
+                    self.rel_distance[i, v, k] = d
+
+        self._locations = {}
+
+    def navigable_locations(self, i, view_index):
+        ''' List of Location objects for state (i, view_index), built once. '''
+        key = (i, view_index)
+        if key not in self._locations:
+            locations = []
+            for k in range(self.nav_count[i, view_index]):
+                j = self.nav_index[i, view_index, k]
+                locations.append(Location(self.viewpoint_ids[j], j, self.points[j],
+                    float(self.rel_heading[i, view_index, k]),
+                    float(self.rel_elevation[i, view_index, k]),
+                    float(self.rel_distance[i, view_index, k])))
+            self._locations[key] = locations
+        return self._locations[key]
+
+    def transition(self, i, view_index, action):
+        ''' Next (viewpoint index, view index) after an env action. '''
+        index, heading_chg, elevation_chg = action
+        assert 0 <= index < self.nav_count[i, view_index], \
+            'Invalid navigable location index %d' % index
+        return self.nav_index[i, view_index, index], \
+            next_view_index(view_index, heading_chg, elevation_chg)
+
+
+_nav_tables = {}
+
+def load_nav_tables(scan, nav_graph_path=None, hfov=None):
+    ''' Process-wide cache of NavTables, shared by all simulators. '''
+    if nav_graph_path is None:
+        nav_graph_path = os.path.join(os.getenv('PT_DATA_DIR', '../../../data'),
+            'connectivity')
+    if hfov is None:
+        hfov = math.radians(60) * 640 / 480
+    key = (os.path.abspath(nav_graph_path), scan, hfov)
+    if key not in _nav_tables:
+        _nav_tables[key] = NavTables(scan, nav_graph_path, hfov)
+    return _nav_tables[key]
+
+
+class GraphSimulator(object):
+    ''' Drop-in replacement for a MatterSim.Simulator with rendering disabled
+    and discretized viewing angles. '''
+
+    def __init__(self):
+        self.image_w = 640
+        self.image_h = 480
+        self.vfov = math.radians(60)
+        self.nav_graph_path = None
+        self.tables = None
+
+    def setRenderingEnabled(self, value):
+        assert not value, 'GraphSimulator cannot render'
+
+    def setDiscretizedViewingAngles(self, value):
+        assert value, 'GraphSimulator only supports discretized viewing angles'
+
+    def setCameraResolution(self, width, height):
+        self.image_w = width
+        self.image_h = height
+
+    def setCameraVFOV(self, vfov):
+        self.vfov = vfov
+
+    def setNavGraphPath(self, path):
+        self.nav_graph_path = path
+
+    def init(self):
+        self.hfov = self.vfov * self.image_w / self.image_h
+
+    def newEpisode(self, scanId, viewpointId, heading, elevation):
+        self.tables = load_nav_tables(scanId, self.nav_graph_path, self.hfov)
+        self.viewpoint = self.tables.index[viewpointId]
+        self.view_index = discretize_view(heading, elevation)
+        self.step = 0
+
+    def makeAction(self, index, heading, elevation):
+        self.viewpoint, self.view_index = self.tables.transition(
+            self.viewpoint, self.view_index, (index, heading, elevation))
+        self.step += 1
+
+    def getState(self):
+        locations = self.tables.navigable_locations(self.viewpoint, self.view_index)
+        return SimState(self.tables.scan, self.step, locations[0], self.view_index,
+            view_heading(self.view_index), view_elevation(self.view_index), locations)
+
+
+def make_simulator(backend='mattersim', image_w=640, image_h=480, vfov=60):
+    ''' Create and initialize a rendering-free simulator with discretized views. '''
+    if backend == 'graph':
+        sim = GraphSimulator()
+    elif backend == 'mattersim':
+        if MatterSim is None:
+            sys.exit('MatterSim is not built; use -simulator graph')
+        sim = MatterSim.Simulator()
+    else:
+        sys.exit('unknown simulator backend: %s' % backend)
+    sim.setRenderingEnabled(False)
+    sim.setDiscretizedViewingAngles(True)
+    sim.setCameraResolution(image_w, image_h)
+    sim.setCameraVFOV(math.radians(vfov))
+    sim.setNavGraphPath(
+        os.path.join(os.getenv('PT_DATA_DIR', '../../../data'), 'connectivity'))
+    sim.init()
+    return sim
+
+
+class BatchedNavTables(object):
+    ''' NavTables of several scans concatenated under one global viewpoint
+    index, so that a batch of agents in different scans can be stepped with
+    NumPy indexing. Scans are only ever appended, so global indices stay valid
+    as more scans are added. '''
+
+    def __init__(self, nav_graph_path=None, hfov=None):
+        self.nav_graph_path = nav_graph_path
+        self.hfov = hfov
+        self.scans = []
+        self.scan_index = {}
+        self.scan_tables = []
+        self.viewpoint_ids = []
+        self.vp_offset = np.zeros(1, dtype=np.int64)
+
+    def add_scans(self, scans):
+        new_scans = sorted(set(scans) - set(self.scan_index))
+        if not new_scans:
+            return
+        for scan in new_scans:
+            tables = load_nav_tables(scan, self.nav_graph_path, self.hfov)
+            self.scan_index[scan] = len(self.scans)
+            self.scans.append(scan)
+            self.scan_tables.append(tables)
+            self.viewpoint_ids.extend(tables.viewpoint_ids)
+        self.vp_offset = np.cumsum([0] + [len(t.viewpoint_ids) for t in self.scan_tables])
+
+        max_count = max(t.nav_index.shape[2] for t in self.scan_tables)
+        def pad(array, value):
+            return np.pad(array, ((0, 0), (0, 0), (0, max_count - array.shape[2])),
+                          'constant', constant_values=value)
+        self.nav_index = np.concatenate([pad(np.where(t.nav_index >= 0, t.nav_index + offset, -1), -1)
+            for t, offset in zip(self.scan_tables, self.vp_offset)]).astype(np.int64)
+        self.nav_count = np.concatenate([t.nav_count for t in self.scan_tables])
+        self.rel_heading = np.concatenate([pad(t.rel_heading, 0.) for t in self.scan_tables])
+        self.rel_elevation = np.concatenate([pad(t.rel_elevation, 0.) for t in self.scan_tables])
+        self.points = np.concatenate([t.points for t in self.scan_tables])
+        self.viewpoint_scan = np.repeat(np.arange(len(self.scans)),
+            [len(t.viewpoint_ids) for t in self.scan_tables])
+
+    def global_index(self, scan, viewpoint):
+        s = self.scan_index[scan]
+        return self.vp_offset[s] + self.scan_tables[s].index[viewpoint]
+
+    def navigable_locations(self, g, view_index):
+        s = self.viewpoint_scan[g]
+        return self.scan_tables[s].navigable_locations(g - self.vp_offset[s], view_index)
+
+    def transition(self, viewpoint, view_index, actions):
+        ''' Vectorized NavTables.transition over arrays of states and a
+        (batch_size, 3) array of env actions. '''
+        index, heading_chg, elevation_chg = actions[:, 0], actions[:, 1], actions[:, 2]
+        assert (index < self.nav_count[viewpoint, view_index]).all(), \
+            'Invalid navigable location index'
+        next_viewpoint = self.nav_index[viewpoint, view_index, index]
+        heading_step = (view_index % HEADING_COUNT + np.sign(heading_chg)) % HEADING_COUNT
+        elevation_step = np.clip(view_index // HEADING_COUNT + np.sign(elevation_chg),
+            0, ELEVATION_COUNT - 1)
+        return next_viewpoint, heading_step + elevation_step * HEADING_COUNT
+
+
+_batched_nav_tables = {}
+
+def load_batched_nav_tables(nav_graph_path=None, hfov=None):
+    ''' Process-wide BatchedNavTables, shared by all batched environments. '''
+    if nav_graph_path is None:
+        nav_graph_path = os.path.join(os.getenv('PT_DATA_DIR', '../../../data'),
+            'connectivity')
+    if hfov is None:
+        hfov = math.radians(60) * 640 / 480
+    key = (os.path.abspath(nav_graph_path), hfov)
+    if key not in _batched_nav_tables:
+        _batched_nav_tables[key] = BatchedNavTables(nav_graph_path, hfov)
+    return _batched_nav_tables[key]
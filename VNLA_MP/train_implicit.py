@@ -7,7 +7,9 @@ from torch import optim
 import torch.nn.functional as F
 
 import os
+import sys
 import time
+import contextlib
 import numpy as np
 import pandas as pd
 import argparse
@@ -20,7 +22,7 @@ from scipy import stats
 
 from utils import read_vocab,write_vocab,build_vocab,Tokenizer,padding_idx,timeSince
 from env import VNLABatch
-from model import AttentionSeq2SeqModel
+from model import AttentionSeq2SeqModel, quantize_dynamic
 from ask_agent import AskAgent
 from verbal_ask_agent import VerbalAskAgent
 
@@ -145,7 +147,9 @@ def train(train_env, val_envs, agent, model, optimizer, start_iter, end_iter,
         if eval_mode:
             loss_str = '\n * eval mode'
         else:
+            train_start = time.time()
             traj = agent.train(train_env, optimizer, interval, train_feedback)
+            train_time = time.time() - train_start
 
             train_losses = np.array(agent.losses)
             assert len(train_losses) == interval
@@ -156,7 +160,11 @@ def train(train_env, val_envs, agent, model, optimizer, start_iter, end_iter,
             train_ask_loss_avg = np.average(np.array(agent.ask_losses))
             loss_str += ', nav loss: %.4f' % train_nav_loss_avg
             loss_str += ', ask loss: %.4f' % train_ask_loss_avg
+            loss_str += ', episodes/sec: %.1f' % (interval * hparams.batch_size / train_time)
             loss_str += compute_ask_stats(traj)
+            if hasattr(agent.advisor, 'cache_info'):
+                loss_str += '\n *** SUBGOAL CACHE: hits %(hits)d, misses %(misses)d, ' \
+                    'size %(size)d / %(max_size)d' % agent.advisor.cache_info()
 
         metrics = defaultdict(dict)
         should_save_ckpt = []
@@ -173,7 +181,9 @@ def train(train_env, val_envs, agent, model, optimizer, start_iter, end_iter,
             loss_str += ', ask loss: %.4f' % val_ask_loss_avg
 
             # Get validation distance from goal under test evaluation conditions
+            test_start = time.time()
             traj = agent.test(env, test_feedback, use_dropout=False, allow_cheat=False)
+            test_time = time.time() - test_start
 
             agent.results_path = os.path.join(hparams.exp_dir,
                 '%s_%s_for_eval.json' % (hparams.model_prefix, env_name))
@@ -209,6 +219,7 @@ def train(train_env, val_envs, agent, model, optimizer, start_iter, end_iter,
                     'original_success_rate', 'original_room_success_rate']:
                     loss_str += ', %s: %.3f' % (metric, val)
 
+            loss_str += '\n *** EVAL: episodes/sec %.1f' % (len(traj) / test_time)
             loss_str += '\n *** OTHER METRICS: '
             # NOTE: only for multi-priority for now:
             if 'first_nav_error' in score_summary:
@@ -292,8 +303,13 @@ def setup(seed=None):
 def train_val(seed=None):
     ''' Train on the training set, and validate on seen and unseen splits. '''
 
-    # which GPU to use
-    device = torch.device('cuda', hparams.device_id)
+    # which GPU to use, or the CPU
+    if hasattr(hparams, 'device') and hparams.device == 'cpu':
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda', hparams.device_id)
+    if hasattr(hparams, 'num_threads') and hparams.num_threads:
+        torch.set_num_threads(hparams.num_threads)
 
     # Resume from lastest checkpoint (if any)
     if os.path.exists(hparams.load_path):
@@ -355,6 +371,12 @@ def train_val(seed=None):
         best_metrics = ckpt['best_metrics']
         train_env.ix = ckpt['data_idx']
 
+    # Quantize the LSTM and Linear weights to int8 for CPU evaluation
+    if hasattr(hparams, 'quantize') and hparams.quantize:
+        if not eval_mode or device.type != 'cpu':
+            sys.exit('-quantize is only supported with -eval_only 1 -device cpu')
+        model = quantize_dynamic(model)
+
     print('')
     pprint(vars(hparams), width=1)
     print('')
@@ -366,6 +388,24 @@ def train_val(seed=None):
     elif hparams.advisor == 'direct':
         agent = AskAgent(model, hparams, device)
 
+    # Fill the subgoal cache of the verbal advisor
+    if 'verbal' in hparams.advisor and hasattr(hparams, 'precompute_subgoals') and \
+            hparams.precompute_subgoals:
+        start = time.time()
+        for env in [train_env] + [env for env, _ in val_envs.values()]:
+            agent.advisor.precompute(env.data)
+        print('Precomputed %d subgoals in %.1fs' % (
+            len(agent.advisor.cache), time.time() - start))
+
+    # Index the teacher actions along the reference trajectories
+    if hasattr(hparams, 'index_teacher_trajectories') and \
+            hparams.index_teacher_trajectories:
+        start = time.time()
+        for env in [train_env] + [env for env, _ in val_envs.values()]:
+            agent.teacher.add_trajectories(env.data)
+        print('Indexed %d teacher actions in %.1fs' % (
+            len(agent.teacher.nav_oracle.trajectory_index), time.time() - start))
+
     # Train
     return train(train_env, val_envs, agent, model, optimizer, start_iter, end_iter,
           best_metrics, eval_mode)
@@ -389,7 +429,12 @@ if __name__ == "__main__":
 
     set_path()
 
-    with torch.cuda.device(hparams.device_id):
+    if hasattr(hparams, 'device') and hparams.device == 'cpu':
+        device_context = contextlib.suppress()  # no-op context
+    else:
+        device_context = torch.cuda.device(hparams.device_id)
+
+    with device_context:
         # Multi-seed evaluation
         if hasattr(hparams, 'multi_seed_eval') and hparams.multi_seed_eval:
             args.eval_only = 1
@@ -10,6 +10,8 @@ import math
 from collections import Counter
 import numpy as np
 import networkx as nx
+import scipy.sparse
+import scipy.sparse.csgraph
 import base64
 import csv
 
@@ -47,6 +49,69 @@ def load_nav_graphs(scan, path=None):
         nx.set_node_attributes(G, values=positions, name='position')
         return G
 
+class ShortestPaths(object):
+    ''' All-pairs shortest paths of one navigation graph, stored as a float32
+    distance matrix and an int16 next-hop matrix indexed by the position of a
+    viewpoint in `viewpoint_ids`. Paths are only reconstructed on request. '''
+
+    def __init__(self, viewpoint_ids, distances, next_hops, positions):
+        self.viewpoint_ids = viewpoint_ids
+        self.index = { viewpoint : i for i, viewpoint in enumerate(viewpoint_ids) }
+        self.distances = distances
+        self.next_hops = next_hops
+        self.positions = positions
+
+    @classmethod
+    def from_graph(cls, graph):
+        viewpoint_ids = list(graph.nodes)
+        index = { viewpoint : i for i, viewpoint in enumerate(viewpoint_ids) }
+        n = len(viewpoint_ids)
+        rows, cols, weights = [], [], []
+        for u, v, w in graph.edges(data='weight'):
+            rows.append(index[u])
+            cols.append(index[v])
+            weights.append(w)
+        adjacency = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(n, n))
+        distances, predecessors = scipy.sparse.csgraph.dijkstra(adjacency,
+            directed=False, return_predecessors=True)
+        # The graph is undirected, so the node after i on the path from i to j
+        # is the predecessor of i on the path from j to i.
+        next_hops = predecessors.T.astype(np.int16)
+        next_hops[next_hops < 0] = -1
+        np.fill_diagonal(next_hops, np.arange(n))
+        positions = np.array([graph.nodes[viewpoint]['position']
+            for viewpoint in viewpoint_ids], dtype=np.float64).reshape(n, 3)
+        return cls(viewpoint_ids, distances.astype(np.float32), next_hops, positions)
+
+    def distance(self, start_point, end_point):
+        return float(self.distances[self.index[start_point], self.index[end_point]])
+
+    def next_point(self, start_point, end_point):
+        ''' Viewpoint after `start_point` on the shortest path to `end_point`. '''
+        return self.viewpoint_ids[
+            self.next_hops[self.index[start_point], self.index[end_point]]]
+
+    def path(self, start_point, end_point):
+        i = self.index[start_point]
+        j = self.index[end_point]
+        assert self.next_hops[i, j] >= 0, \
+            'No path from %s to %s' % (start_point, end_point)
+        path = [i]
+        while i != j:
+            i = self.next_hops[i, j]
+            path.append(i)
+        return [self.viewpoint_ids[i] for i in path]
+
+    def nearest(self, start_point, end_points):
+        ''' Distance to and id of the nearest of `end_points`. '''
+        d = self.distances[self.index[start_point],
+            [self.index[end_point] for end_point in end_points]]
+        k = int(np.argmin(d))
+        return float(d[k]), end_points[k]
+
+    def position(self, viewpoint):
+        return self.positions[self.index[viewpoint]]
+
 def load_region_map(scan):
     DATA_DIR = os.getenv('PT_DATA_DIR', '../../../data')
     region_map = {}
@@ -77,6 +142,8 @@ class Tokenizer(object):
             for i,word in enumerate(vocab):
                 self.word_to_index[word] = i
         self.split_by_spaces = split_by_spaces
+        # Sentence -> word indices in reading order (see encode_words)
+        self.word_cache = {}
 
     def split_sentence(self, sentence):
         if self.split_by_spaces:
@@ -127,6 +194,36 @@ class Tokenizer(object):
 
         return encoding
 
+    def encode_words(self, sentence, cache=True):
+        ''' Word indices of a sentence in reading order, without reversal,
+        <EOS> or padding. Cached per sentence unless `cache` is False. '''
+        if sentence in self.word_cache:
+            return self.word_cache[sentence]
+        if len(self.word_to_index) == 0:
+            sys.exit('Tokenizer has no vocab')
+        unk = self.word_to_index['<UNK>']
+        words = tuple(self.word_to_index.get(word, unk)
+            for word in self.split_sentence(sentence))
+        if cache:
+            self.word_cache[sentence] = words
+        return words
+
+    def encode_batch(self, word_seqs, encoding_length=None):
+        ''' encode_sentence for a batch of encode_words outputs: one
+        (batch_size, encoding_length) array of reversed, <EOS>-terminated and
+        padded encodings. '''
+        if encoding_length is None:
+            encoding_length = self.encoding_length
+        encoding = np.full((len(word_seqs), encoding_length), self.word_to_index['<PAD>'],
+            dtype=np.int64)
+        eos = self.word_to_index['<EOS>']
+        for i, words in enumerate(word_seqs):
+            n = min(len(words), encoding_length)
+            encoding[i, :n] = words[::-1][:n]
+            if n < encoding_length:
+                encoding[i, n] = eos
+        return encoding
+
 def build_vocab(path, splits, min_count, max_length, start_vocab=base_vocab,
     split_by_spaces=False, prefix=''):
 
@@ -194,21 +291,191 @@ def read_subgoal_vocab(paths):
     print('Read vocab of size', len(vocab))
     return vocab
 
-def load_img_features(path):
+tsv_fieldnames = ['scanId', 'viewpointId', 'image_w','image_h', 'vfov', 'features']
+img_feature_dtypes = ['float32', 'float16', 'int8']
+
+
+class ImageFeatures(object):
+    ''' Read-only `scanId_viewpointId` -> (36, feature_size) mapping backed by
+    a single (n_viewpoints, 36, feature_size) array. When the array is a
+    memory map, lookups are zero-copy slices into the page cache.
+
+    Features may be stored as float16, or as int8 with one float32 scale per
+    (viewpoint, view); `view` upcasts only the requested row to float32. '''
+
+    def __init__(self, data, long_ids, scales=None):
+        self.data = data
+        self.scales = scales
+        self.index = { long_id : i for i, long_id in enumerate(long_ids) }
+
+    def view(self, long_id, view_index):
+        i = self.index[long_id]
+        row = self.data[i][view_index]
+        if self.scales is not None:
+            return row.astype(np.float32) * self.scales[i, view_index]
+        return row.astype(np.float32, copy=False)
+
+    def views(self, rows, view_indices):
+        ''' Batched `view` over arrays of row numbers (see `index`) and view
+        indices; returns a (batch_size, feature_size) float32 array. '''
+        if isinstance(self.data, list):
+            features = np.stack([self.data[r][v] for r, v in zip(rows, view_indices)])
+        else:
+            features = self.data[rows, view_indices]
+        if self.scales is not None:
+            return features.astype(np.float32) * self.scales[rows, view_indices][:, None]
+        return features.astype(np.float32, copy=False)
+
+    def __getitem__(self, long_id):
+        i = self.index[long_id]
+        if self.scales is not None:
+            return self.data[i].astype(np.float32) * self.scales[i][:, None]
+        return self.data[i].astype(np.float32, copy=False)
+
+    def __contains__(self, long_id):
+        return long_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+
+def quantize_img_features(data, dtype):
+    ''' Cast a float32 (n, 36, feature_size) array to `dtype`. For int8,
+    also return the per-(viewpoint, view) scales. '''
+    if dtype == 'float32':
+        return data, None
+    if dtype == 'float16':
+        return data.astype(np.float16), None
+    if dtype == 'int8':
+        scales = np.abs(data).max(axis=2) / 127.
+        scales[scales == 0] = 1.
+        quantized = np.rint(data / scales[:, :, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+    raise ValueError('Unknown image feature dtype %s' % dtype)
+
+def img_features_cache_paths(path, dtype='float32'):
+    ''' Paths of the binary cache written by `convert_img_features` for a TSV:
+    (features, int8 scales or None, index). '''
+    prefix = os.path.splitext(path)[0]
+    index_path = prefix + '.index.json'
+    if dtype == 'float32':
+        return prefix + '.npy', None, index_path
+    scale_path = prefix + '.int8.scale.npy' if dtype == 'int8' else None
+    return prefix + '.%s.npy' % dtype, scale_path, index_path
+
+def convert_img_features(path, dtype='float32', chunk_size=1000):
+    ''' Convert the TSV image features to a contiguous .npy file and a json
+    index, which `load_img_features` memory-maps on later runs. Reduced
+    precision caches are derived from the float32 one. '''
+    cache_path, scale_path, index_path = img_features_cache_paths(path, dtype)
+
+    if dtype != 'float32':
+        float_cache_path = img_features_cache_paths(path)[0]
+        if not os.path.exists(float_cache_path):
+            convert_img_features(path)
+        float_data = np.load(float_cache_path, mmap_mode='r')
+        print('Converting %s to %s' % (float_cache_path, cache_path))
+        data = np.lib.format.open_memmap(cache_path + '.tmp', mode='w+',
+            dtype=np.dtype(dtype), shape=float_data.shape)
+        scales = np.empty(float_data.shape[:2], dtype=np.float32)
+        for i in range(0, float_data.shape[0], chunk_size):
+            data[i:i+chunk_size], chunk_scales = quantize_img_features(
+                np.asarray(float_data[i:i+chunk_size]), dtype)
+            if chunk_scales is not None:
+                scales[i:i+chunk_size] = chunk_scales
+        data.flush()
+        del data
+        if scale_path is not None:
+            np.save(scale_path, scales)
+        os.replace(cache_path + '.tmp', cache_path)
+        return cache_path, index_path
+
+    with open(path, "rt") as tsv_in_file:
+        n_rows = sum(1 for _ in tsv_in_file)
+
+    print('Converting %d viewpoints from %s to %s' % (n_rows, path, cache_path))
+    long_ids = []
+    tmp_cache_path = cache_path + '.tmp'
+    data = None
+    with open(path, "rt") as tsv_in_file:
+        reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames=tsv_fieldnames)
+        for i, item in enumerate(reader):
+            feature = np.frombuffer(
+                    base64.decodebytes(bytearray(item['features'], 'utf-8')),
+                    dtype=np.float32).reshape((36, -1))
+            if data is None:
+                data = np.lib.format.open_memmap(tmp_cache_path, mode='w+',
+                    dtype=np.float32, shape=(n_rows,) + feature.shape)
+                image_h = int(item['image_h'])
+                image_w = int(item['image_w'])
+                vfov = int(item['vfov'])
+            data[i] = feature
+            long_ids.append(item['scanId'] + '_' + item['viewpointId'])
+    data.flush()
+    del data
+    os.replace(tmp_cache_path, cache_path)
+
+    with open(index_path, 'w') as f:
+        json.dump({ 'image_h'  : image_h,
+                    'image_w'  : image_w,
+                    'vfov'     : vfov,
+                    'long_ids' : long_ids }, f)
+
+    return cache_path, index_path
+
+def _load_img_features_cache(cache_path, scale_path, index_path):
+    print('Memory-mapping image features from %s' % cache_path)
+    with open(index_path) as f:
+        index = json.load(f)
+    data = np.load(cache_path, mmap_mode='r')
+    scales = np.load(scale_path) if scale_path is not None else None
+    assert data.shape[0] == len(index['long_ids']), \
+        'Image feature cache %s does not match its index' % cache_path
+    return index['image_h'], index['image_w'], index['vfov'], \
+        ImageFeatures(data, index['long_ids'], scales=scales)
+
+def load_img_features(path, dtype='float32'):
+    ''' Load image features stored as `dtype` from a .npy cache (see
+    `convert_img_features`) if one exists next to `path`, otherwise parse the
+    TSV and cast in memory. '''
+    if path.endswith('.npy'):
+        return _load_img_features_cache(path, None,
+            os.path.splitext(path)[0] + '.index.json')
+    cache_path, scale_path, index_path = img_features_cache_paths(path, dtype)
+    if os.path.exists(cache_path) and os.path.exists(index_path):
+        return _load_img_features_cache(cache_path, scale_path, index_path)
+
+    float_cache_path, _, _ = img_features_cache_paths(path)
+    if os.path.exists(float_cache_path) and os.path.exists(index_path):
+        image_h, image_w, vfov, features = \
+            _load_img_features_cache(float_cache_path, None, index_path)
+        print('Casting image features to %s in memory (run '
+              '`python convert_img_features.py -dtype %s` to cache this)' % (dtype, dtype))
+        data, scales = quantize_img_features(np.asarray(features.data), dtype)
+        return image_h, image_w, vfov, \
+            ImageFeatures(data, list(features.keys()), scales=scales)
+
     print('Loading image features from %s' % path)
-    tsv_fieldnames = ['scanId', 'viewpointId', 'image_w','image_h', 'vfov', 'features']
-    features = {}
+    print('(run `python convert_img_features.py %s` once to speed this up)' % path)
+    long_ids = []
+    features = []
     with open(path, "rt") as tsv_in_file:
         reader = csv.DictReader(tsv_in_file, delimiter='\t', fieldnames=tsv_fieldnames)
         for i, item in enumerate(reader):
             image_h = int(item['image_h'])
             image_w = int(item['image_w'])
             vfov = int(item['vfov'])
-            long_id = item['scanId'] + '_' + item['viewpointId']
-            features[long_id] = np.frombuffer(
+            long_ids.append(item['scanId'] + '_' + item['viewpointId'])
+            features.append(np.frombuffer(
                     base64.decodebytes(bytearray(item['features'], 'utf-8')),
-                    dtype=np.float32).reshape((36, 2048))
-    return image_h, image_w, vfov, features
+                    dtype=np.float32).reshape((36, 2048)))
+    if dtype != 'float32':
+        data, scales = quantize_img_features(np.stack(features), dtype)
+        return image_h, image_w, vfov, ImageFeatures(data, long_ids, scales=scales)
+    return image_h, image_w, vfov, ImageFeatures(features, long_ids)
 
 def load_region_label_to_name():
     region_label_to_name = {}
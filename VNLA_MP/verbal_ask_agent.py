@@ -19,7 +19,7 @@ import torch.nn.functional as F
 
 from utils import padding_idx
 from agent import BaseAgent
-from oracle import make_oracle
+from oracle import make_oracle, AskOracle
 from ask_agent import AskAgent
 
 class VerbalAskAgent(AskAgent):
@@ -37,10 +37,45 @@ class VerbalAskAgent(AskAgent):
             sys.exit('unknown advisor: %s' % hparams.advisor)
 
         self.advisor = make_oracle('verbal', hparams.n_subgoal_steps,
-            self.nav_actions, self.ask_actions, mode=mode)
+            self.nav_actions, self.ask_actions, mode=mode,
+            cache_size=hparams.subgoal_cache_size
+                if hasattr(hparams, 'subgoal_cache_size') else 100000)
         self.hparams = hparams
         self.teacher_interpret = hasattr(hparams, 'teacher_interpret') and hparams.teacher_interpret
 
+    def _reencode_rows(self, obs, rows, ctx, seq_mask, cov):
+        ''' Encode the instructions of `rows` only and scatter their context
+        into `ctx` and `seq_mask`, widening them if a new instruction is
+        longer. The coverage vectors of these rows restart from zero. '''
+        seq, new_mask, seq_lengths = self._make_batch([obs[i] for i in rows])
+        new_ctx, _ = self.model.encode(seq, seq_lengths)
+        # Under autocast, the dtype of the encoder output can depend on the batch
+        new_ctx = new_ctx.to(ctx.dtype)
+
+        width = max(ctx.size(1), new_ctx.size(1))
+        if width > ctx.size(1):
+            pad = width - ctx.size(1)
+            ctx = F.pad(ctx, (0, 0, 0, pad))
+            seq_mask = torch.cat((seq_mask, seq_mask.new_ones(seq_mask.size(0), pad)), 1)
+            if cov is not None:
+                cov = F.pad(cov, (0, 0, 0, pad))
+        pad = width - new_ctx.size(1)
+        new_ctx = F.pad(new_ctx, (0, 0, 0, pad))
+        new_mask = torch.cat((new_mask, new_mask.new_ones(new_mask.size(0), pad)), 1)
+
+        index = torch.tensor(rows, dtype=torch.long, device=self.device)
+        seq_mask = seq_mask.index_copy(0, index, new_mask)
+        if torch.is_grad_enabled():
+            # Earlier decoding steps still need the old context for backward
+            ctx = ctx.index_copy(0, index, new_ctx)
+            if cov is not None:
+                cov = cov.index_fill(0, index, 0)
+        else:
+            ctx.index_copy_(0, index, new_ctx)
+            if cov is not None:
+                cov.index_fill_(0, index, 0)
+        return ctx, seq_mask, cov
+
     def rollout(self):
         # Reset environment
         obs = self.env.reset(self.is_eval)
@@ -83,6 +118,7 @@ class VerbalAskAgent(AskAgent):
             self.nav_actions.index('<start>')
         q_t = torch.ones(batch_size, dtype=torch.long, device=self.device) * \
             self.ask_actions.index('<start>')
+        q_t_list = [self.ask_actions.index('<start>')] * batch_size
 
         # Whether agent decides to stop
         ended = np.array([False] * batch_size)
@@ -95,44 +131,41 @@ class VerbalAskAgent(AskAgent):
 
         env_action = [None] * batch_size
         queries_unused = [ob['max_queries'] for ob in obs]
+        traj_lens = np.array([ob['traj_len'] for ob in obs])
+        # Number of trailing steps spent at the same viewpoint
+        unmoved = np.ones(batch_size, dtype=np.int64)
+
+        # Rollout state kept on the device; the masks are refilled in place
+        queries_unused_t = torch.tensor(queries_unused, dtype=torch.long, device=self.device)
+        traj_lens_t = torch.from_numpy(traj_lens).long().to(self.device)
+        nav_logit_mask = torch.zeros(batch_size,
+            AskAgent.n_output_nav_actions(), dtype=torch.uint8, device=self.device)
+        ask_logit_mask = torch.zeros(batch_size,
+            AskAgent.n_output_ask_actions(), dtype=torch.uint8, device=self.device)
 
         episode_len = max(ob['traj_len'] for ob in obs)
         for time_step in range(episode_len):
             # Mask out invalid actions
-            nav_logit_mask = torch.zeros(batch_size,
-                AskAgent.n_output_nav_actions(), dtype=torch.uint8, device=self.device)
-            ask_logit_mask = torch.zeros(batch_size,
-                AskAgent.n_output_ask_actions(), dtype=torch.uint8, device=self.device)
-
-            nav_mask_indices = []
-            ask_mask_indices = []
-            for i, ob in enumerate(obs):
-                if len(ob['navigableLocations']) <= 1:
-                    nav_mask_indices.append((i, self.nav_actions.index('forward')))
-
-                if queries_unused[i] <= 0:
-                    ask_mask_indices.append((i, self.ask_actions.index('ask')))
-
-            nav_logit_mask[list(zip(*nav_mask_indices))] = 1
-            ask_logit_mask[list(zip(*ask_mask_indices))] = 1
+            self._fill_logit_masks(obs, nav_logit_mask, ask_logit_mask, queries_unused_t)
 
             # Image features
             f_t = self._feature_variable(obs)
 
             # Budget features
-            b_t = torch.tensor(queries_unused, dtype=torch.long, device=self.device)
+            b_t = queries_unused_t
 
             # Run first forward pass to compute ask logit
-            _, _, nav_logit, nav_softmax, ask_logit, _ = self.model.decode(
+            _, _, nav_logit, nav_softmax, ask_logit, _, decoder_step = self.model.decode_cached(
                 a_t, q_t, f_t, decoder_h, ctx, seq_mask, nav_logit_mask,
                 ask_logit_mask, budget=b_t, cov=cov)
+            prev_q_t_list = q_t_list
 
             self._populate_agent_state_to_obs(obs, nav_softmax, queries_unused,
                 traj, ended, time_step)
 
             # Ask teacher for next ask action
-            ask_target, ask_reason = self.teacher.next_ask(obs)
-            ask_target = torch.tensor(ask_target, dtype=torch.long, device=self.device)
+            ask_target, ask_reason = self.teacher.next_ask_batch(obs, nav_softmax,
+                queries_unused_t, traj_lens_t, time_step, unmoved, ended)
             if not self.is_eval and not (self.random_ask or self.ask_first or self.teacher_ask or self.no_ask):
                 self.ask_loss += self.ask_criterion(ask_logit, ask_target)
 
@@ -140,10 +173,12 @@ class VerbalAskAgent(AskAgent):
             q_t = self._next_action('ask', ask_logit, ask_target, self.ask_feedback)
 
             # Find which agents have asked and prepend subgoals to their current instructions.
-            ask_target_list = ask_target.data.tolist()
-            q_t_list = q_t.data.tolist()
+            # One host sync for the ask decisions, one for the nav actions below
+            ask_target_list, ask_reason_list, q_t_list = self._to_host(
+                ask_target, ask_reason, q_t)
             has_asked = False
             verbal_subgoals = [None] * batch_size
+            askers = []
             for i in range(batch_size):
                 if ask_target_list[i] != self.ask_actions.index('<ignore>'):
                     if self.random_ask:
@@ -156,38 +191,45 @@ class VerbalAskAgent(AskAgent):
                         q_t_list[i] = 0
 
                 if self._should_ask(ended[i], q_t_list[i]):
-                    # Query advisor for subgoal.
-                    action_subgoals[i], verbal_subgoals[i] = self.advisor(obs[i])
-                    # Prepend subgoal to the current instruction
-                    self.env.prepend_instruction(i, verbal_subgoals[i])
-                    # Reset subgoal step index
-                    n_subgoal_steps[i] = 0
-                    # Decrement queries unused
-                    queries_unused[i] -= 1
-                    # Mark that some agent has asked
-                    has_asked = True
+                    askers.append(i)
+
+            # Query advisor for the subgoals of all agents that asked at once.
+            if askers:
+                for i, subgoal in zip(askers,
+                        self.advisor.batch_call([obs[i] for i in askers])):
+                    action_subgoals[i], verbal_subgoals[i] = subgoal
+
+            for i in askers:
+                # Prepend subgoal to the current instruction
+                words = self.advisor.subgoal_words(action_subgoals[i], self.env.tokenizer) \
+                    if self.env.tokenizer.split_by_spaces else None
+                self.env.prepend_instruction(i, verbal_subgoals[i], words)
+                # Reset subgoal step index
+                n_subgoal_steps[i] = 0
+                # Decrement queries unused
+                queries_unused[i] -= 1
+                # Mark that some agent has asked
+                has_asked = True
 
             if has_asked:
                 # Update observations
                 obs = self.env.get_obs(obs)
-                # Make new batch with new instructions
-                seq, seq_mask, seq_lengths = self._make_batch(obs)
-                # Re-encode with new instructions
-                ctx, _ = self.model.encode(seq, seq_lengths)
-                # Make new coverage vectors
-                if self.coverage_size is not None:
-                    cov = torch.zeros(seq_mask.size(0), seq_mask.size(1), self.coverage_size,
-                        dtype=torch.float, device=self.device)
-                else:
-                    cov = None
+                # Re-encode the new instructions of the agents that asked
+                ctx, seq_mask, cov = self._reencode_rows(obs, askers, ctx, seq_mask, cov)
 
             # Run second forward pass to compute nav logit
             # NOTE: q_t and b_t changed since the first forward pass.
-            q_t = torch.tensor(q_t_list, dtype=torch.long, device=self.device)
-            b_t = torch.tensor(queries_unused, dtype=torch.long, device=self.device)
-            decoder_h, alpha, nav_logit, nav_softmax, cov = self.model.decode_nav(
-                a_t, q_t, f_t, decoder_h, ctx, seq_mask, nav_logit_mask,
-                budget=b_t, cov=cov)
+            if self.random_ask or self.ask_first or self.teacher_ask or self.no_ask:
+                q_t = torch.tensor(q_t_list, dtype=torch.long, device=self.device)
+            queries_unused_t = self._set_rows(queries_unused_t, askers,
+                [queries_unused[i] for i in askers])
+            b_t = queries_unused_t
+            # Only agents whose ask action or instruction changed are recomputed
+            changed = sorted(set(askers).union(i for i in range(batch_size)
+                if q_t_list[i] != prev_q_t_list[i]))
+            decoder_h, alpha, nav_logit, nav_softmax, cov = self.model.decode_nav_rows(
+                decoder_step, changed, a_t, q_t, f_t, decoder_h, ctx, seq_mask,
+                nav_logit_mask, budget=b_t, cov=cov)
 
             # Repopulate agent state
             # NOTE: queries_unused may have changed but it's fine since nav_teacher does not use it!
@@ -204,7 +246,8 @@ class VerbalAskAgent(AskAgent):
             a_t = self._next_action('nav', nav_logit, nav_target, self.nav_feedback)
 
             # Translate agent action to environment action
-            a_t_list = a_t.data.tolist()
+            a_t_list, = self._to_host(a_t)
+            overridden = []
             for i in range(batch_size):
                 # Conditioned on teacher action during intervention
                 # (training only or when teacher_interpret flag is on)
@@ -212,23 +255,25 @@ class VerbalAskAgent(AskAgent):
                     n_subgoal_steps[i] < len(action_subgoals[i]):
                     a_t_list[i] = action_subgoals[i][n_subgoal_steps[i]]
                     n_subgoal_steps[i] += 1
+                    overridden.append(i)
 
                 env_action[i] = self.teacher.interpret_agent_action(a_t_list[i], obs[i])
 
-            a_t = torch.tensor(a_t_list, dtype=torch.long, device=self.device)
+            a_t = self._set_rows(a_t, overridden, [a_t_list[i] for i in overridden])
 
             # Take nav action
             obs = self.env.step(env_action, obs)
 
             # Save trajectory output
-            ask_target_list = ask_target.data.tolist()
             for i, ob in enumerate(obs):
                 if not ended[i]:
+                    unmoved[i] = unmoved[i] + 1 \
+                        if ob['viewpoint'] == traj[i]['agent_path'][-1][0] else 1
                     traj[i]['agent_path'].append((ob['viewpoint'], ob['heading'], ob['elevation']))
                     traj[i]['agent_nav'].append(env_action[i])
                     traj[i]['teacher_ask'].append(ask_target_list[i])
                     traj[i]['agent_ask'].append(q_t_list[i])
-                    traj[i]['teacher_ask_reason'].append(ask_reason[i])
+                    traj[i]['teacher_ask_reason'].append(AskOracle.REASONS[ask_reason_list[i]])
                     traj[i]['subgoals'].append(verbal_subgoals[i])
 
                     if a_t_list[i] == self.nav_actions.index('<end>') or \
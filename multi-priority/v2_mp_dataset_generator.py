@@ -10,11 +10,8 @@ import sys
 import numpy as np
 
 import utils
-sys.path.append('../../build')
-import MatterSim
-
-import utils
-sys.path.append('../../build')
+from path_cache import load_shortest_paths, load_scans
+from simulator import make_simulator
 
 '''
 This file generates a multi-priority dataset from the original VNLA dataset.
@@ -22,53 +19,33 @@ V2: Now the natural-language priority descriptions will be more varied.
 Also, path length checking is included.
 '''
 
+# Simulator backend: 'mattersim' or 'graph' (pure Python, no C++ build needed)
+SIMULATOR = 'mattersim' # CHANGE HERE
+
 class PathCalculator(object):
   ''' Generate paths for tasks '''
 
-  def __init__(self):
+  def __init__(self, simulator=SIMULATOR):
+    self.simulator = simulator
     self.scans = set()
-    self.graph = {}
     self.paths = {}
-    self.distances = {}
 
   def init_sim(self):
-    self.sim = MatterSim.Simulator()
-    self.sim.setRenderingEnabled(False)
-    self.sim.setDiscretizedViewingAngles(True)
-    self.sim.setCameraResolution(640, 480)
-    self.sim.setCameraVFOV(math.radians(60))
-    self.sim.setNavGraphPath(
-        os.path.join(os.getenv('PT_DATA_DIR', '../../../data'), 'connectivity'))
-    self.sim.init()
+    self.sim = make_simulator(self.simulator)
 
   def add_scans(self, scans, path=None):
     new_scans = set.difference(scans, self.scans)
     if new_scans:
       print('Loading navigation graphs for %d scans' % len(new_scans))
-      for scan in new_scans:
-        graph, paths, distances = self._compute_shortest_paths(scan, path=path)
-        self.graph[scan] = graph
-        self.paths[scan] = paths
-        self.distances[scan] = distances
+      self.paths.update(load_scans(new_scans, path=path))
       self.scans.update(new_scans)  
 
   def _compute_shortest_paths(self, scan, path=None):
     ''' Load connectivity graph for each scan, useful for reasoning about shortest paths '''
-    graph = utils.load_nav_graphs(scan, path=path)
-    paths = dict(nx.all_pairs_dijkstra_path(graph))
-    distances = dict(nx.all_pairs_dijkstra_path_length(graph))
-    return graph, paths, distances
+    return load_shortest_paths(scan, path=path)
 
   def _find_nearest_point(self, scan, start_point, end_points):
-      best_d = 1e9
-      best_point = None
-
-      for end_point in end_points:
-          d = self.distances[scan][start_point][end_point]
-          if d < best_d:
-              best_d = d
-              best_point = end_point
-      return best_d, best_point
+      return self.paths[scan].nearest(start_point, end_points)
 
   def _shortest_path_action(self, ob):
       ''' Determine next action on the shortest path to goals. '''
@@ -83,8 +60,7 @@ class PathCalculator(object):
       if start_point == goal_point:
           return (0, 0, 0)
 
-      path = self.paths[scan][start_point][goal_point]
-      next_point = path[1]
+      next_point = self.paths[scan].next_point(start_point, goal_point)
 
       # Can we see the next viewpoint?
       for i, loc in enumerate(ob['navigableLocations']):
@@ -108,7 +84,7 @@ class PathCalculator(object):
           return (0, 0,-1) # Look down
 
       # Otherwise decide which way to turn
-      target_rel = self.graph[ob['scan']].nodes[next_point]['position'] - ob['point']
+      target_rel = self.paths[ob['scan']].position(next_point) - ob['point']
       target_heading = math.pi / 2.0 - math.atan2(target_rel[1], target_rel[0])
       if target_heading < 0:
           target_heading += 2.0 * math.pi
@@ -288,11 +264,11 @@ def combine_two_tasks(task1, task2, path_calculator):
   start = new_task['start_viewpoint']
   is_valid = True
   for first_goal in first_goal_viewpoints:
-    first_leg = path_calculator.paths[scan][start][first_goal]
+    first_leg = path_calculator.paths[scan].path(start, first_goal)
     if not is_valid:
       break
     for second_goal in second_goal_viewpoints:
-      second_leg = path_calculator.paths[scan][first_goal][second_goal]
+      second_leg = path_calculator.paths[scan].path(first_goal, second_goal)
       trajectory, is_traj_valid = generate_task_trajectory(new_task, first_goal, second_goal, path_calculator)
       is_path_valid = check_path_validity(first_leg) and check_path_validity(second_leg)
       if not (is_traj_valid and is_path_valid):